@@ -16,10 +16,45 @@
 
 import datetime as dt
 import collections as cs
+import copy as cp
+import hashlib as hl
+import importlib as il
+import multiprocessing as mp
+import json as js
+import os as os
+import re as re
+import sys as sys
+import timeit as ti
 import numpy as np
-import scipy.stats as ss
-import networkx as nx
 import cPickle as pk
+import zipfile as zf
+
+# Peak memory figures for RunObserver come from getrusage, which only unix has
+try:
+	import resource as rsc
+except ImportError:
+	rsc = None
+
+class LazyModule():
+	'''Stands in for a module until one of its attributes is first used and only then imports it, so
+	importing nbs doesn't pay for scipy and networkx before they're needed.'''
+
+	def __init__(self, moduleName):
+		self.moduleName = moduleName
+		self.module = None
+
+	def __getattr__(self, name):
+
+		if self.module is None:
+			self.module = il.import_module(self.moduleName)
+
+		return getattr(self.module, name)
+
+ss = LazyModule('scipy.stats')
+sf = LazyModule('scipy.special')
+sp = LazyModule('scipy.sparse')
+csg = LazyModule('scipy.sparse.csgraph')
+nx = LazyModule('networkx')
 
 #This is a python implementation of the Network-base statistic proposed by Andrew Zalesky in his 
 #paper Network-based statistic: Identifying differences in brain networks.
@@ -28,10 +63,91 @@ import cPickle as pk
 
 class DataParameters():
 	
-	def __init__(self, label, threshold, totalNodes):
+	def __init__(self, label, threshold, totalNodes, symmetric=False):
 		self.label = label
 		self.threshold = threshold
 		self.totalNodes = totalNodes
+		
+		# Symmetric connectivity mtxs only store and test the i < j edges of the upper triangle
+		self.symmetric = symmetric
+		self.edgeRows = None
+		self.edgeCols = None
+		
+	def isSweep(self):
+		'''True when a list of thresholds was given, the first of which is the primary one.'''
+		
+		return isinstance(self.threshold, (list, tuple, np.ndarray))
+		
+	def getThresholds(self):
+		
+		if self.isSweep():
+			return list(self.threshold)
+		else:
+			return [self.threshold]
+		
+	def getSeriesKeys(self):
+		'''Returns the keys this label's null distributions are stored under, the label itself for the
+		primary threshold plus a (label, threshold) key for every threshold of a sweep.'''
+		
+		if self.isSweep():
+			return [self.label] + [(self.label, threshold) for threshold in self.threshold]
+		else:
+			return [self.label]
+		
+	def getUndirectedEdges(self, tStats):
+		'''Returns the i <= j node pair and |tstat| of every distinct link.  For full mtxs a link is as
+		strong as the stronger of its (i,j) and (j,i) entries.'''
+		
+		if self.symmetric:
+			rows, cols = self.getEdgeIndexes()
+			return rows, cols, np.abs(tStats)
+		
+		tStatMtx = np.abs(tStats.reshape((self.totalNodes, self.totalNodes)))
+		rows, cols = np.triu_indices(self.totalNodes)
+		
+		return rows, cols, np.fmax(tStatMtx[rows, cols], tStatMtx[cols, rows])
+		
+	def getSupraThreshEdges(self, tStats, threshold):
+		'''Returns the (i,j) node pair of every stored edge whose |tstat| is above threshold, as a pair of
+		int32 arrays taken straight from the flat tStats.'''
+		
+		supraThreshEdges = np.flatnonzero(np.abs(tStats) > threshold)
+		
+		if self.symmetric:
+			rows, cols = self.getEdgeIndexes()
+			return rows[supraThreshEdges].astype(np.int32), cols[supraThreshEdges].astype(np.int32)
+		
+		# Full mtxs are flattened row by row so the i,j come straight out of the flat index
+		return (supraThreshEdges // self.totalNodes).astype(np.int32), (supraThreshEdges % self.totalNodes).astype(np.int32)
+		
+	def getEdgeCount(self):
+		
+		if self.symmetric:
+			return self.totalNodes * (self.totalNodes - 1) // 2
+		else:
+			return self.totalNodes * self.totalNodes
+		
+	def getEdgeIndexes(self):
+		'''Returns the (i,j) node pair of every stored edge, in the order the edges are cached.'''
+		
+		if self.edgeRows is None:
+			if self.symmetric:
+				self.edgeRows, self.edgeCols = np.triu_indices(self.totalNodes, 1)
+			else:
+				self.edgeRows, self.edgeCols = np.indices((self.totalNodes, self.totalNodes)).reshape((2, -1))
+		
+		return self.edgeRows, self.edgeCols
+	
+	def flattenData(self, data):
+		'''Flattens a subject's nodeCount X nodeCount mtx into the edge vector that gets cached.'''
+		
+		data = np.asarray(data)
+		
+		if self.symmetric:
+			rows, cols = self.getEdgeIndexes()
+			return data.reshape((self.totalNodes, self.totalNodes))[rows, cols]
+		else:
+			return data.flatten()
 
 class TStatResult():
 	
@@ -40,6 +156,158 @@ class TStatResult():
 		self.tStats = None
 		self.pVals = None
 
+def findComponents(rows, cols, totalNodes):
+	'''Labels the connected components of the undirected graph made up of the edges (rows[i], cols[i]).
+	Returns the component label of every node (-1 for nodes without any edges) along with the edge
+	and node counts of every component.  Edges are counted once however many times they're listed.'''
+
+	rows = np.asarray(rows, dtype=int)
+	cols = np.asarray(cols, dtype=int)
+
+	# Put every edge in i <= j order and drop any duplicates, (i,j) and (j,i) are the same link
+	edgeKeys = np.unique(np.minimum(rows, cols) * totalNodes + np.maximum(rows, cols))
+	lows = edgeKeys // totalNodes
+	highs = edgeKeys % totalNodes
+
+	adjacency = sp.coo_matrix((np.ones(len(edgeKeys)), (lows, highs)), shape=(totalNodes, totalNodes))
+	componentCount, rawLabels = csg.connected_components(adjacency, directed=False)
+
+	# Only nodes that are part of at least one edge belong to a component
+	hasEdge = np.zeros(totalNodes, dtype=bool)
+	hasEdge[lows] = True
+	hasEdge[highs] = True
+
+	labels = np.empty(totalNodes, dtype=int)
+	labels.fill(-1)
+	componentIds, labels[hasEdge] = np.unique(rawLabels[hasEdge], return_inverse=True)
+
+	edgeCounts = np.bincount(labels[lows], minlength=len(componentIds))
+	nodeCounts = np.bincount(labels[hasEdge], minlength=len(componentIds))
+
+	return labels, edgeCounts, nodeCounts
+
+def findLargestComponent(rows, cols, weights, threshold, totalNodes):
+	'''Null distribution kernel that goes straight from the weights of a set of distinct edges to the
+	extent of the largest component above threshold and a boolean mask of the nodes in it.  Picks the
+	same component as Graph when several tie for largest.'''
+
+	supraThresh = weights > threshold
+	supraRows = rows[supraThresh]
+	supraCols = cols[supraThresh]
+
+	if len(supraRows) == 0:
+		return 0, np.zeros(totalNodes, dtype=bool)
+
+	adjacency = sp.coo_matrix((np.ones(len(supraRows)), (supraRows, supraCols)), shape=(totalNodes, totalNodes))
+	componentCount, labels = csg.connected_components(adjacency, directed=False)
+
+	edgeCounts = np.bincount(labels[supraRows], minlength=componentCount)
+	largest = np.argmax(edgeCounts)
+
+	return int(edgeCounts[largest]), labels == largest
+
+def findNodeOverlap(nodeMasks):
+	'''Returns a boolean mask of the nodes that are in the largest component of every data series, given
+	a series x nodes array of largest component node masks.  A leading permutation axis is handled the
+	same way, giving a permutations x nodes result.  A single series has nothing to overlap with.'''
+
+	nodeMasks = np.asarray(nodeMasks, dtype=bool)
+
+	if nodeMasks.shape[-2] < 2:
+		return np.zeros(nodeMasks.shape[0:-2] + nodeMasks.shape[-1:], dtype=bool)
+
+	return np.logical_and.reduce(nodeMasks, axis=-2)
+
+def findThresholdExtents(rows, cols, weights, thresholds, totalNodes):
+	'''Returns the largest component extent of the graph made up of the edges whose weight is above
+	each of the given thresholds.  The graphs are nested, so thresholds are worked through from the
+	highest down and each step only adds the edges between it and the one before.  Components found so
+	far are contracted to single nodes so the new edges just merge them.  Edges must be distinct.'''
+
+	extents = {}
+
+	# Current component of every node and the # of edges in each component
+	labels = np.arange(totalNodes)
+	edgeCounts = np.zeros(totalNodes)
+
+	# Nothing below the lowest threshold is ever needed
+	keep = weights > min(thresholds)
+	rows, cols, weights = rows[keep], cols[keep], weights[keep]
+
+	upper = np.inf
+	for threshold in sorted(thresholds, reverse=True):
+
+		newEdges = (weights > threshold) & (weights <= upper)
+		newRows = labels[rows[newEdges]]
+		newCols = labels[cols[newEdges]]
+
+		# Merge the components the new edges join up, the contracted graph has one node per component
+		adjacency = sp.coo_matrix((np.ones(len(newRows)), (newRows, newCols)), shape=(len(edgeCounts), len(edgeCounts)))
+		componentCount, merged = csg.connected_components(adjacency, directed=False)
+
+		edgeCounts = np.bincount(merged, edgeCounts, componentCount) + np.bincount(merged[newRows], minlength=componentCount)
+		labels = merged[labels]
+
+		extents[threshold] = int(edgeCounts.max()) if len(edgeCounts) > 0 else 0
+		upper = threshold
+
+	return [extents[threshold] for threshold in thresholds]
+
+# Component statistics that can each get their own null distribution: the # of edges (the usual NBS
+# extent), the # of nodes, the summed |tstat| of the edges (intensity) and the largest |tstat|
+COMPONENT_STATISTICS = ['extent', 'nodes', 'intensity', 'maxT']
+
+def getNullKey(seriesKey, statistic):
+	'''Returns the key a statistic's null distribution is stored under, extents keep the series key.'''
+
+	if statistic == 'extent':
+		return seriesKey
+	else:
+		return (seriesKey, statistic)
+
+def getNullType(key):
+	'''Null distributions of |tstat| sums and maxima hold floats, the rest hold counts.'''
+
+	if isinstance(key, tuple) and key[-1] in ('intensity', 'maxT'):
+		return np.float64
+	else:
+		return np.int32
+
+def findComponentStatistics(rows, cols, weights, threshold, totalNodes, statistics):
+	'''Like findLargestComponent but returns the largest value any component above threshold reaches
+	of each of the given statistics, as a dict, along with the largest component's node mask.'''
+
+	supraThresh = weights > threshold
+	supraRows = rows[supraThresh]
+	supraCols = cols[supraThresh]
+	supraWeights = weights[supraThresh]
+
+	if len(supraRows) == 0:
+		return dict((statistic, 0) for statistic in statistics), np.zeros(totalNodes, dtype=bool)
+
+	adjacency = sp.coo_matrix((np.ones(len(supraRows)), (supraRows, supraCols)), shape=(totalNodes, totalNodes))
+	componentCount, labels = csg.connected_components(adjacency, directed=False)
+
+	edgeLabels = labels[supraRows]
+	edgeCounts = np.bincount(edgeLabels, minlength=componentCount)
+	largest = np.argmax(edgeCounts)
+
+	values = {}
+	for statistic in statistics:
+		if statistic == 'extent':
+			values[statistic] = int(edgeCounts[largest])
+		elif statistic == 'nodes':
+			hasEdge = np.zeros(totalNodes, dtype=bool)
+			hasEdge[supraRows] = True
+			hasEdge[supraCols] = True
+			values[statistic] = int(np.bincount(labels[hasEdge]).max())
+		elif statistic == 'intensity':
+			values[statistic] = float(np.bincount(edgeLabels, supraWeights).max())
+		elif statistic == 'maxT':
+			values[statistic] = float(supraWeights.max())
+
+	return values, labels == largest
+
 class Component():
 
 	def __init__(self, rawSubGraph):
@@ -47,6 +315,9 @@ class Component():
 		self.rawSubGraph = rawSubGraph
 		self.pVal = None
 		
+		# P value of every component statistic asked for, pVal being the one of the extent
+		self.pVals = {}
+		
 	def nodes(self):
 		return self.rawSubGraph.nodes()
 	
@@ -61,128 +332,285 @@ class Component():
 		
 class Graph():
 	
-	def __init__(self):
+	def __init__(self, buildSubGraphs=True):
 		
 		self.rawGraph = nx.Graph()
 		self.components = []
 		self.largestComponent = None
 		
+		# Component arrays from findComponents, the networkx subgraphs are only built when asked for
+		self.buildSubGraphs = buildSubGraphs
+		self.componentLabels = None
+		self.componentEdgeCounts = np.zeros(0, dtype=int)
+		self.componentNodeCounts = np.zeros(0, dtype=int)
+		self.largestComponentIndex = None
+		
+		# Suprathresh edges as an edges x 2 array, enough to rebuild the graph from
+		self.coords = np.zeros((0, 2), dtype=int)
+		
+		# Summed and max |tstat| of the edges of each component, only set when asked for
+		self.componentIntensities = None
+		self.componentMaxT = None
+		
 	def setCoords(self, coords):
 		
+		coords = np.asarray(list(coords), dtype=np.int32).reshape((-1, 2))
+		
+		self.setEdges(coords[:, 0], coords[:, 1])
+		
+	def setEdges(self, rows, cols):
+		'''Sets the graph's edges from arrays of their i and j nodes, like setCoords without the tuples.'''
+		
+		self.coords = np.column_stack((rows, cols)).astype(np.int32).reshape((-1, 2))
+		coords = self.coords
+		totalNodes = coords.max() + 1 if len(coords) > 0 else 0
+		
+		# Label the components straight from the edge list
+		self.componentLabels, self.componentEdgeCounts, self.componentNodeCounts = findComponents(coords[:, 0], coords[:, 1], totalNodes)
+		
+		if len(self.componentEdgeCounts) > 0:
+			self.largestComponentIndex = int(np.argmax(self.componentEdgeCounts))
+		
+		if not self.buildSubGraphs:
+			return
+		
 		# Build base graph
-		for coord in coords:
-			self.rawGraph.add_edge(*coord)
-
-		# Get all of the subgraphs of this graph
-		rawSubGraphs = nx.components.connected_component_subgraphs(self.rawGraph)
+		self.rawGraph.add_edges_from(coords.tolist())
 		
-		# Pull out the largest component of this graph
-		for rawSubGraph in rawSubGraphs:
+		# Pull out a subgraph for each component and keep track of the largest
+		for idx in range(len(self.componentEdgeCounts)):
 
-			component = Component(rawSubGraph)
+			component = Component(self.rawGraph.subgraph(np.flatnonzero(self.componentLabels == idx).tolist()).copy())
 			self.components.append(component)
 			
-			if (self.largestComponent == None) or (rawSubGraph.size() > self.largestComponent.size()):
+			if idx == self.largestComponentIndex:
 				self.largestComponent = component
 		return
 	
 	def getComponentCount(self):
 
-		return len(self.components)
+		return len(self.componentEdgeCounts)
 
 	def getLargestComponentSize(self):
 	
-		if self.largestComponent != None:
-			return self.largestComponent.size()
+		if self.largestComponentIndex != None:
+			return int(self.componentEdgeCounts[self.largestComponentIndex])
 		else:
 			return 0
+	
+	def setEdgeWeights(self, rows, cols, weights):
+		'''Works out the summed and max |tstat| of each component, given the i <= j node pair and
+		|tstat| of every suprathresh link, e.g. from DataParameters.getUndirectedEdges.'''
+		
+		edgeLabels = self.componentLabels[rows]
+		
+		self.componentIntensities = np.bincount(edgeLabels, weights, minlength=self.getComponentCount())
+		self.componentMaxT = np.zeros(self.getComponentCount())
+		np.maximum.at(self.componentMaxT, edgeLabels, weights)
+		
+	def getComponentStatistic(self, statistic):
+		'''Returns the value of a component statistic for every component, in component order.'''
+		
+		if statistic == 'extent':
+			return self.componentEdgeCounts
+		elif statistic == 'nodes':
+			return self.componentNodeCounts
+		elif statistic == 'intensity':
+			return self.componentIntensities
+		elif statistic == 'maxT':
+			return self.componentMaxT
+		
+	def getLargestComponentMask(self, totalNodes):
+		'''Returns a boolean mask over totalNodes nodes of the nodes in the largest component.'''
+	
+		nodeMask = np.zeros(totalNodes, dtype=bool)
+		
+		if self.largestComponentIndex != None:
+			nodeMask[0:len(self.componentLabels)] = self.componentLabels == self.largestComponentIndex
+			
+		return nodeMask
 
 	@staticmethod
 	def getNodeOverlapStrict(graphs):
+		'''Returns the nodes that are in the largest component of every graph.'''
 	
-		base = []
-		overlap = []
+		graphs = list(graphs)
+		totalNodes = max([0] + [len(graph.componentLabels) for graph in graphs if graph.componentLabels is not None])
 		
-		for graph in graphs:
-	
-			if graph.largestComponent == None:
-				return []
-			
-			if len(base) == 0:
-				for node in graph.largestComponent.nodes():
-					base.append(node)
-			else:
-				for node in graph.largestComponent.nodes():
-					if node in base:
-						overlap.append(node)
-		return overlap
+		nodeMasks = np.zeros((len(graphs), totalNodes), dtype=bool)
+		for idx, graph in enumerate(graphs):
+			nodeMasks[idx] = graph.getLargestComponentMask(totalNodes)
+		
+		return np.flatnonzero(findNodeOverlap(nodeMasks)).tolist()
 		
 class GroupResult():
 	
 	def __init__(self):
 		self.dataSeriesGraphs = {}
 		
+		# Extra graphs of the actual comparison for threshold sweeps, keyed by (label, threshold)
+		self.thresholdGraphs = {}
+		
 	def addGraph(self, dataParameter, graph):
 		self.dataSeriesGraphs[dataParameter.label] = graph
 		
+	def addThresholdGraph(self, dataParameter, threshold, graph):
+		self.thresholdGraphs[(dataParameter.label, threshold)] = graph
+		
+	def getSeriesGraphs(self):
+		'''Returns every graph keyed the same way as the null distributions they're scored against.'''
+		
+		graphs = dict(self.dataSeriesGraphs)
+		graphs.update(self.thresholdGraphs)
+		
+		return graphs
+		
 	def getNodeOverlap(self):
 		return Graph.getNodeOverlapStrict(self.dataSeriesGraphs.values())
 
-class PermutationResult():
+class PermutationResult(object):
 	
-	def __init__(self):
-		# Member to hold raw group results
-		self.groupResults = []
+	# Fixed set of members keeps the per label arrays from dragging a __dict__ along with them
+	__slots__ = ['groupResultsLength', 'capacity', 'extentsBySeries', 'overlapCounts', 'nodeCounts', 'sortedExtents']
+	
+	def __init__(self, iterations=0, totalNodes=0):
+		
 		self.groupResultsLength = 0
 		
-		self.cmpExtBySeries = cs.defaultdict(list)
-		self.nodeOverlapCounts = []
-		self.nodeTotals = {}
+		# Accumulators are preallocated for the expected # of iterations and only grow if overrun
+		self.capacity = iterations
+		self.extentsBySeries = {}
+		self.overlapCounts = np.zeros(iterations, dtype=np.int32)
+		self.nodeCounts = np.zeros(totalNodes, dtype=np.int64)
+		
+		# Sorted copies of the extent distributions, rebuilt lazily after new results come in
+		self.sortedExtents = {}
+		
+	def __getstate__(self):
+		return dict((name, getattr(self, name)) for name in self.__slots__)
+	
+	def __setstate__(self, state):
+		for name, value in state.iteritems():
+			setattr(self, name, value)
+	
+	@property
+	def cmpExtBySeries(self):
+		return dict((label, extents[0:self.groupResultsLength]) for label, extents in self.extentsBySeries.iteritems())
+	
+	@property
+	def nodeOverlapCounts(self):
+		return self.overlapCounts[0:self.groupResultsLength]
+	
+	@property
+	def nodeTotals(self):
+		return dict((int(node), int(self.nodeCounts[node])) for node in np.flatnonzero(self.nodeCounts))
+	
+	def reserve(self, iterations):
+		'''Makes sure there's room for at least this many permutations, growing geometrically.'''
+		
+		if iterations <= self.capacity:
+			return
+		
+		self.capacity = max(iterations, 2 * self.capacity)
+		
+		for label, extents in self.extentsBySeries.iteritems():
+			self.extentsBySeries[label] = np.resize(extents, self.capacity)
+		self.overlapCounts = np.resize(self.overlapCounts, self.capacity)
+	
+	def reserveNodes(self, totalNodes):
+		
+		if totalNodes > len(self.nodeCounts):
+			self.nodeCounts = np.concatenate((self.nodeCounts, np.zeros(totalNodes - len(self.nodeCounts), dtype=np.int64)))
+	
+	def getSeriesExtents(self, label):
+		
+		if not label in self.extentsBySeries:
+			self.extentsBySeries[label] = np.zeros(self.capacity, dtype=getNullType(label))
+		
+		return self.extentsBySeries[label]
 		
 	def addResult(self, grpRes):
 		
-		# Save the individual permutation result
-		# TODO: Might have to eliminate this eventually d/t size/memory issues
-		#self.groupResults.append(grpRes)
-		self.groupResultsLength = self.groupResultsLength + 1
-
-		# Store the largest component extent for each data series
+		extents = {}
+		
 		for label, graph in grpRes.dataSeriesGraphs.iteritems():
-			self.cmpExtBySeries[label].append(graph.getLargestComponentSize())
+			extents[label] = graph.getLargestComponentSize()
+		
+		self.addPermutation(extents, grpRes.getNodeOverlap())
+		
+	def addPermutation(self, extents, nodes):
+		'''Stores one permutation given the largest component extent of each data series (keyed as in
+		getSeriesKeys) and the list of overlapping nodes, without needing any Graph objects.'''
 		
-		# Get list of overlapping nodes
-		nodes = grpRes.getNodeOverlap()
+		idx = self.groupResultsLength
+		self.reserve(idx + 1)
+		self.sortedExtents.clear()
+
+		# Store the largest component extent for each data series and threshold
+		for key, extent in extents.iteritems():
+			self.getSeriesExtents(key)[idx] = extent
 		
 		# Save count of overlapping nodes
-		self.nodeOverlapCounts.append(len(nodes))
+		self.overlapCounts[idx] = len(nodes)
 		
 		# Keep track of overlapping node ids as well as total permutation counts
-		for node in nodes:
-			if self.nodeTotals.has_key(node):
-				self.nodeTotals[node] = self.nodeTotals[node] + 1
-			else:
-				self.nodeTotals[node] = 1
+		if len(nodes) > 0:
+			self.reserveNodes(max(nodes) + 1)
+			self.nodeCounts[np.asarray(nodes)] += 1
 
-	def getComponentPVal(self, seriesLabel, componentExtent):
+		self.groupResultsLength = idx + 1
+
+	def merge(self, other):
+		'''Appends the permutations held in another result, e.g. a partial result from a worker process'''
 
-		seriesDist = self.cmpExtBySeries[seriesLabel]
-		seriesDist = np.array(seriesDist)
+		self.addPermutations(other.cmpExtBySeries, other.nodeOverlapCounts, other.nodeCounts)
+
+	def addPermutations(self, extentsBySeries, overlapCounts, nodeCounts):
+		'''Appends a run of permutations given as plain arrays, e.g. as read back from a file.'''
 		
-		# Find the number of components (from the distribution) larger than this one
-		idxs = np.where(seriesDist > componentExtent)
-	
-		if len(idxs[0]) > 0:
-			# Calculate the pvalue
-			return float(float(len(idxs[0])) / float(self.groupResultsLength))
-		else:
-			return 0
+		start = self.groupResultsLength
+		stop = start + len(overlapCounts)
+		
+		self.reserve(stop)
+		self.sortedExtents.clear()
+		
+		for key, extents in extentsBySeries.iteritems():
+			self.getSeriesExtents(key)[start:stop] = extents
+		
+		self.overlapCounts[start:stop] = overlapCounts
+		
+		self.reserveNodes(len(nodeCounts))
+		self.nodeCounts[0:len(nodeCounts)] += nodeCounts
+		
+		self.groupResultsLength = stop
+
+	def getComponentPVals(self, seriesLabel, componentExtents):
+		'''Scores a whole set of component extents against the null distribution of a data series at once.
+		The p value of each is the fraction of permutations with a larger largest component.'''
+		
+		componentExtents = np.asarray(componentExtents)
+		
+		if self.groupResultsLength == 0 or not seriesLabel in self.extentsBySeries:
+			return np.zeros(componentExtents.shape)
+		
+		if not seriesLabel in self.sortedExtents:
+			self.sortedExtents[seriesLabel] = np.sort(self.cmpExtBySeries[seriesLabel])
+		
+		# Find the number of components (from the distribution) larger than each of these
+		larger = self.groupResultsLength - np.searchsorted(self.sortedExtents[seriesLabel], componentExtents, 'right')
+		
+		return larger / float(self.groupResultsLength)
+
+	def getComponentPVal(self, seriesLabel, componentExtent):
+		
+		return float(self.getComponentPVals(seriesLabel, [componentExtent])[0])
 
 	def getOverlapNodePVal(self, ident):
-		if self.nodeTotals.has_key(ident):
-			nodeCount = self.nodeTotals[ident]
-			return nodeCount, self.groupResultsLength, float(int(nodeCount)) / float(self.groupResultsLength)
+		if ident < len(self.nodeCounts) and self.nodeCounts[ident] > 0:
+			nodeCount = int(self.nodeCounts[ident])
+			return nodeCount, self.groupResultsLength, float(nodeCount) / float(self.groupResultsLength)
 		else:
-			return 0, len(self.groupResults), 0
+			return 0, self.groupResultsLength, 0
 
 	def getMaxOverlapSize(self):
 		return np.max(self.nodeOverlapCounts)
@@ -190,168 +618,2006 @@ class PermutationResult():
 	def getOverlapHistogram(self):
 		return np.bincount(self.nodeOverlapCounts)
 
-class ComparisonResult():
+class SequentialStoppingRule():
+	'''Stops a permutation run early once every component p value is known to be on one side of alpha.
+	After each block a Clopper-Pearson interval is put around each p value, and the run stops when none
+	of the intervals contain alpha anymore.  Exact runs, which have to enumerate every assignment or
+	sign flip for their p values to hold, are never stopped.'''
 	
-	def __init__(self):
-		self.actualResult = None
-		self.permutationResult = None
+	def __init__(self, alpha=0.05, confidence=0.99, minIterations=100):
+		self.alpha = alpha
+		self.confidence = confidence
+		self.minIterations = minIterations
+		
+	def getPValIntervals(self, exceedCounts, iterations):
+		'''Returns the lower and upper bounds of the exact binomial interval for each count.'''
+		
+		exceedCounts = np.asarray(exceedCounts, dtype=float)
+		tail = (1.0 - self.confidence) / 2.0
+		
+		with np.errstate(invalid='ignore'):
+			lower = np.where(exceedCounts > 0, ss.beta.ppf(tail, exceedCounts, iterations - exceedCounts + 1), 0.0)
+			upper = np.where(exceedCounts < iterations, ss.beta.ppf(1.0 - tail, exceedCounts + 1, iterations - exceedCounts), 1.0)
+		
+		return lower, upper
+		
+	def isResolved(self, permutationResult, actualResult, statistics=['extent']):
+		'''True once each component of the actual result is clearly significant or clearly not, by each
+		of the component statistics given p values, see tStatNBS.getStatistics.'''
+		
+		iterations = permutationResult.groupResultsLength
+		
+		if iterations < self.minIterations:
+			return False
+		
+		for label, graph in actualResult.getSeriesGraphs().iteritems():
+			
+			if graph.getComponentCount() == 0:
+				continue
+			
+			for statistic in statistics:
+				
+				pVals = permutationResult.getComponentPVals(getNullKey(label, statistic), graph.getComponentStatistic(statistic))
+				lower, upper = self.getPValIntervals(np.round(pVals * iterations), iterations)
+				
+				if np.any((lower <= self.alpha) & (upper >= self.alpha)):
+					return False
+		
+		return True
 
-class DataCacheItem():
+class PermutationCheckpoint():
+	'''Keeps a running permutation result on disk so a long run can pick up where it left off.  The
+	per permutation extents and overlap counts are appended to raw binary files, while the node counts
+	and the state of the permutation stream are kept together in a state file rewritten each time the
+	checkpoint is saved, so a single rename commits both.'''
 	
-	def __init__(self):
-		self.subjectIndex = None
-		self.data = None
+	def __init__(self, path, interval=1000):
+		self.path = path
+		self.interval = interval
 		
-class tStatNBS():
+		# Number of permutations already written to the data files
+		self.savedLength = 0
+		self.labels = None
+		
+	def getFileName(self, name):
+		return os.path.join(self.path, name)
 	
-	def __init__(self):
-		self.subDataByLabel = {}
+	def getExtentFileName(self, label):
+		return self.getFileName('extents.%d.bin' % self.labels.index(label))
 	
-	def cacheData(self, group1, group2, dataParameters):
-
-		#if np.size(group1, axis=1) != np.size(group2, axis=1):
-		#	raise IndexError()
+	def exists(self):
+		return os.path.exists(self.getFileName('state.pkl'))
+	
+	def start(self, seed, blockSize, labels, groupSizes, exact=False, subjectIds=None, layout=None):
+		'''Sets up an empty checkpoint for a new run, or checks an existing one was written by the same
+		kind of run over the same subjects, in the same order, and returns its seed so the permutation
+		stream carries on where it stopped.  layout holds whatever else the nulls depend on, e.g. the
+		thresholds, see tStatNBS.getRunLayout.'''
 		
-		subs = []
-		subs.extend(group1)
-		subs.extend(group2)
+		if not os.path.isdir(self.path):
+			os.makedirs(self.path)
 		
-		for parm in dataParameters:
-
-			dci = DataCacheItem()
+		subjectIds = None if subjectIds is None else list(subjectIds)
+		
+		if not self.exists():
 			
-			dci.subjectIndex = {}
-			dci.data = None
+			self.labels = list(labels)
+			self.writeState({'seed' : seed, 'blockSize' : blockSize, 'labels' : self.labels, 'groupSizes' : groupSizes, 'exact' : exact,
+				'subjectIds' : subjectIds, 'layout' : layout, 'length' : 0, 'nodeCounts' : np.zeros(0, dtype=np.int64)})
 			
-			self.subDataByLabel[parm.label] = dci
+			for name in [self.getExtentFileName(label) for label in self.labels] + [self.getFileName('overlapCounts.bin')]:
+				open(name, 'wb').close()
 			
-			for idx, sub in enumerate(subs):
-
-				data = np.asarray(sub.data[parm.label]).flatten()
-				
-				if dci.data == None:
-					dci.data = np.empty( (len(subs), data.shape[0]) )
-				
-				dci.subjectIndex[sub.subjectId] = idx
-				dci.data[idx] = data
-		return
-				
-	def getSubjectData(self, subject, dataParameter):
-	
-		subDataKey = str(subject.subjectId) + dataParameter.label
+			return seed
 		
-		if self.cachedSubjectData.has_key(subDataKey):
-			return self.cachedSubjectData[subDataKey]
-		else:
-			dataItm = np.asarray(subject.data[dataParameter.label]).flatten()
-			self.cachedSubjectData[subDataKey] = dataItm
-			return dataItm
-			
+		state = self.readState()
 		
-	def tTestGroups(self, group1, group2, dataParameter):
-		'''This method takes two groups of subjects and compares their data by label and returns tStats and 
-		pVals for that label.  It flattens the data before comparing.'''
-
-		dataCache = self.subDataByLabel[dataParameter.label]
+		if state['blockSize'] != blockSize or state['groupSizes'] != groupSizes or state.get('exact', False) != exact or sorted(state['labels']) != sorted(labels) or state.get('layout') != layout:
+			raise ValueError('Checkpoint at %s was written by a different comparison' % self.path)
 		
-		# Pull and flatten the data for each of the groups and store
-		# in a temporary array
-		grp1 = []
-		for subject in group1:
-			dataIdx = dataCache.subjectIndex[subject.subjectId]
-			grp1.append(dataIdx)
-			
-		grp2 = []
-		for subject in group2:
-			dataIdx = dataCache.subjectIndex[subject.subjectId]
-			grp2.append(dataIdx)
-
-		grp1Data = dataCache.data[grp1]
-		grp2Data = dataCache.data[grp2]
+		if state.get('subjectIds') != subjectIds:
+			raise ValueError('Checkpoint at %s was written for different subjects' % self.path)
+		
+		self.labels = state['labels']
+		
+		return state['seed']
 	
-		result = TStatResult()
+	def resume(self, result, iterations):
+		'''Loads the saved permutations into an empty result and returns how many there were.  Anything
+		written to the data files past the last saved state (e.g. by a crash) is thrown away.'''
 		
-		# Generate T stats and P vals for each array index by comparing groups using independent T test
-		resArr = ss.ttest_ind(grp1Data, grp2Data, axis = 0)
-		result.tStats = resArr[0]
-		result.pVals = resArr[1]
+		state = self.readState()
+		length = state['length']
 		
-		return result
+		# The node counts are only saved as totals so a run can't be cut short of what's on disk
+		if length > iterations:
+			raise ValueError('Checkpoint at %s holds %d permutations, more than the %d requested' % (self.path, length, iterations))
 		
-	def compareGroups(self, group1, group2, dataParameters):
-		'''Creates a graph for each data label that is made up of nodes that are above the thresh 
-		tstat of interest.  Note:  group1 and group2 must be the same axis 1 length'''
+		result.reserve(length)
 		
-		result = GroupResult()
-	
-		for dataParameter in dataParameters:
-	
-			# Pull out the comparison result for this label
-			tresult = self.tTestGroups(group1, group2, dataParameter)
-			
-			# Change tStats into mtx of shape nodeCount X nodeCount
-			tStatMtx = np.abs(tresult.tStats.reshape((dataParameter.totalNodes, dataParameter.totalNodes)))
-			
-			# Figure out which i,j are above our threshold and mark them with a 1
-			supraThreshLinks = np.where(tStatMtx > dataParameter.threshold)
-			supraThreshAdjMtx = np.zeros((dataParameter.totalNodes, dataParameter.totalNodes))
-			supraThreshAdjMtx[supraThreshLinks] = 1
-	
-			# Create an NBSGraph to contain our suprathresh results
-			graph = Graph()
-			
-			# Store our suprathresh coords
-			graph.setCoords(zip(*np.where(supraThreshAdjMtx > 0)))
+		for label in self.labels:
+			result.getSeriesExtents(label)[0:length] = np.fromfile(self.getExtentFileName(label), dtype=getNullType(label), count=length)
+		result.overlapCounts[0:length] = np.fromfile(self.getFileName('overlapCounts.bin'), dtype=np.int32, count=length)
 		
-			# Store the graph for this data series
-			result.addGraph(dataParameter, graph)
+		result.groupResultsLength = length
 		
-		return result
+		if length > 0:
+			nodeCounts = state['nodeCounts']
+			result.reserveNodes(len(nodeCounts))
+			result.nodeCounts[0:len(nodeCounts)] = nodeCounts
+		
+		# Drop anything past the saved length so new permutations get appended in the right place
+		for name, dataType in [(self.getExtentFileName(label), getNullType(label)) for label in self.labels] + [(self.getFileName('overlapCounts.bin'), np.int32)]:
+			with open(name, 'r+b') as dataFile:
+				dataFile.truncate(length * np.dtype(dataType).itemsize)
+		
+		self.savedLength = length
+		
+		return length
 	
-	def getRandomDistribution(self, group1, group2, dataParameters, iterations):
+	def save(self, result):
+		'''Appends the permutations added to the result since the last save and commits the new state.'''
+		
+		start = self.savedLength
+		stop = result.groupResultsLength
+		
+		extentsBySeries = result.cmpExtBySeries
+		for label in self.labels:
+			self.appendArray(self.getExtentFileName(label), extentsBySeries[label][start:stop], getNullType(label))
+		self.appendArray(self.getFileName('overlapCounts.bin'), result.nodeOverlapCounts[start:stop])
+		
+		# Node counts are small and change everywhere so they're rewritten in one piece, along with
+		# the length they go with, a crash before the rename leaves both as they were
+		state = self.readState()
+		state['length'] = stop
+		state['nodeCounts'] = result.nodeCounts.astype(np.int64)
+		self.writeState(state)
+		
+		self.savedLength = stop
 	
-		allSubjects = []
+	def appendArray(self, name, data, dataType=np.int32):
+		
+		with open(name, 'ab') as dataFile:
+			dataFile.write(np.asarray(data, dtype=dataType).tostring())
+			dataFile.flush()
+			os.fsync(dataFile.fileno())
 	
-		# Put all subjects together for easy shuffling
-		allSubjects.extend(group1)
-		allSubjects.extend(group2)
+	def replaceFile(self, name, contents):
 		
-		result = PermutationResult()
-				
-		# Perform desired # of iterations
-		for i in range(iterations):
+		# Write to the side and rename so a crash never leaves a half written file behind
+		tempName = self.getFileName(name + '.tmp')
+		with open(tempName, 'wb') as tempFile:
+			tempFile.write(contents)
+			tempFile.flush()
+			os.fsync(tempFile.fileno())
+		
+		os.rename(tempName, self.getFileName(name))
 	
-			# Mix up all of the subjects
-			np.random.shuffle(allSubjects)
+	def readState(self):
+		
+		with open(self.getFileName('state.pkl'), 'rb') as stateFile:
+			return pk.load(stateFile)
 	
-			# Grab new groups of same sizes as originals
-			randomGroup1 = allSubjects[0:len(group1)]
-			randomGroup2 = allSubjects[len(group1):len(group1)+len(group2)]
+	def writeState(self, state):
+		
+		self.replaceFile('state.pkl', pk.dumps(state, pk.HIGHEST_PROTOCOL))
 
-			# Get our component graph from random labels
-			permResult = self.compareGroups(randomGroup1, randomGroup2, dataParameters)
+class PermutationShard():
+	'''Permutations start to stop of a run, along with what's needed to check that shards belong to
+	the same run.  Shards can be saved to and loaded from compact .npz files, so a run can be split
+	across machines and merged back into the PermutationResult a single process would have given.'''
 
-			# Store our group result for this permutation
-			result.addResult(permResult)
-		
-		# Return the permutation results
-		return result
-	
-	def compare(self, group1, group2, dataParameters, iterations):
+	def __init__(self, start, stop, runInfo, result):
+		self.start = start
+		self.stop = stop
+		self.runInfo = runInfo
+		self.result = result
 
-		result = ComparisonResult()
+	def save(self, fileName):
 
-		self.cacheData(group1, group2, dataParameters)
-		
-		# Compare groups for actual labels
-		result.actualResult = self.compareGroups(group1, group2, dataParameters)
-			
-		# Generate group comparisons based on random group assignments
-		result.permutationResult = self.getRandomDistribution(group1, group2, dataParameters, iterations)
-				
-		# Calculate p values for the components of each data series
-		for label, graph in result.actualResult.dataSeriesGraphs.iteritems():
-			for compnent in graph.components:
-				compnent.pVal = result.permutationResult.getComponentPVal(label, compnent.size())
+		header = {'start' : self.start, 'stop' : self.stop, 'runInfo' : self.runInfo}
+		arrays = {'header' : np.frombuffer(pk.dumps(header, pk.HIGHEST_PROTOCOL), dtype=np.uint8),
+			'overlapCounts' : self.result.nodeOverlapCounts, 'nodeCounts' : self.result.nodeCounts}
+
+		extentsBySeries = self.result.cmpExtBySeries
+		for idx, key in enumerate(self.runInfo['seriesKeys']):
+			arrays['extents.%d' % idx] = extentsBySeries[key]
+
+		with open(fileName, 'wb') as shardFile:
+			np.savez_compressed(shardFile, **arrays)
+
+	@staticmethod
+	def load(fileName):
+
+		with np.load(fileName) as arrays:
+
+			header = pk.loads(arrays['header'].tostring())
+			runInfo = header['runInfo']
+
+			result = PermutationResult(header['stop'] - header['start'])
+			extents = dict((key, arrays['extents.%d' % idx]) for idx, key in enumerate(runInfo['seriesKeys']))
+			result.addPermutations(extents, arrays['overlapCounts'], arrays['nodeCounts'])
+
+		return PermutationShard(header['start'], header['stop'], runInfo, result)
+
+	@staticmethod
+	def merge(shards):
+		'''Merges shards from the same run, which between them have to cover it from the first
+		permutation on without gaps or overlaps, into a single PermutationResult.'''
+
+		if len(shards) == 0:
+			raise ValueError('There are no shards to merge')
+
+		shards = sorted(shards, key=lambda shard: shard.start)
+
+		result = PermutationResult(shards[-1].stop)
+
+		position = 0
+		for shard in shards:
+
+			if shard.runInfo != shards[0].runInfo:
+				raise ValueError('Shards come from different permutation runs')
+			if shard.start != position:
+				raise ValueError('Shards leave permutations %d to %d uncovered or covered twice' % (min(position, shard.start), max(position, shard.start)))
+
+			result.merge(shard.result)
+			position = shard.stop
+
+		if position != shards[0].runInfo['iterations']:
+			raise ValueError('Shards leave permutations %d to %d uncovered' % (position, shards[0].runInfo['iterations']))
+
+		return result
+
+class RunObserver():
+	'''Receives the progress of permutation runs when set as tStatNBS.observer, override whichever of
+	the methods are needed.  Every call gets a dict with:
+
+		completed, iterations   permutations done so far (resumed ones included) and in the whole run
+		elapsed                 seconds since the run started
+		permutationsPerSecond   throughput of this run so far
+		stageTimes              cumulative seconds per stage: tTest, thresholding, components and
+		                        accumulation, summed over worker processes
+		peakBlockBytes          largest t stat and node mask arrays of a single block
+		cacheBytes              size of the cached data being t tested
+		peakMemory              peak resident bytes of this process and its workers, None if unknown
+
+	Stage timing only happens while an observer is set, so runs without one cost nothing extra.'''
+
+	def runStarted(self, progress):
+		pass
+
+	def blockFinished(self, progress):
+		pass
+
+	def runFinished(self, progress):
+		pass
+
+class JSONLinesReporter(RunObserver):
+	'''Writes every progress update as a line of JSON, to a file (appended to) or sys.stdout, so the
+	throughput of long runs can be followed and graphed.  Only every interval'th block is written.'''
+
+	def __init__(self, fileName=None, interval=1):
+		self.fileName = fileName
+		self.interval = max(interval, 1)
+		self.blockCount = 0
+
+	def writeLine(self, event, progress):
+
+		line = dict(progress)
+		line['event'] = event
+		line['time'] = dt.datetime.now().isoformat()
+
+		if self.fileName is None:
+			sys.stdout.write(js.dumps(line, sort_keys=True) + '\n')
+			sys.stdout.flush()
+		else:
+			with open(self.fileName, 'a') as reportFile:
+				reportFile.write(js.dumps(line, sort_keys=True) + '\n')
+
+	def runStarted(self, progress):
+		self.blockCount = 0
+		self.writeLine('runStarted', progress)
+
+	def blockFinished(self, progress):
+		self.blockCount = self.blockCount + 1
+		if self.blockCount % self.interval == 0:
+			self.writeLine('blockFinished', progress)
+
+	def runFinished(self, progress):
+		self.writeLine('runFinished', progress)
+
+class RunProgress():
+	'''Keeps the figures handed to a RunObserver up to date over a run.'''
+
+	def __init__(self, completed, iterations, cacheBytes):
+
+		self.startTime = ti.default_timer()
+		self.startCompleted = completed
+		self.stageTimes = dict((stage, 0.0) for stage in ['tTest', 'thresholding', 'components', 'accumulation'])
+
+		self.progress = {'completed' : completed, 'iterations' : iterations, 'elapsed' : 0.0, 'permutationsPerSecond' : 0.0,
+			'stageTimes' : self.stageTimes, 'peakBlockBytes' : 0, 'cacheBytes' : cacheBytes, 'peakMemory' : self.getPeakMemory()}
+
+	def getPeakMemory(self):
+
+		if rsc is None:
+			return None
+
+		# Linux gives kB, OS X bytes
+		scale = 1 if sys.platform == 'darwin' else 1024
+
+		return scale * (rsc.getrusage(rsc.RUSAGE_SELF).ru_maxrss + rsc.getrusage(rsc.RUSAGE_CHILDREN).ru_maxrss)
+
+	def update(self, completed, blockTimes=None, blockBytes=0):
+		'''Adds a finished block's stage times and returns a copy of the progress so far.'''
+
+		for stage, seconds in (blockTimes or {}).iteritems():
+			self.stageTimes[stage] = self.stageTimes[stage] + seconds
+
+		elapsed = ti.default_timer() - self.startTime
+
+		self.progress['completed'] = completed
+		self.progress['elapsed'] = elapsed
+		self.progress['permutationsPerSecond'] = (completed - self.startCompleted) / elapsed if elapsed > 0 else 0.0
+		self.progress['peakBlockBytes'] = max(self.progress['peakBlockBytes'], blockBytes)
+		self.progress['peakMemory'] = self.getPeakMemory()
+
+		progress = dict(self.progress)
+		progress['stageTimes'] = dict(self.stageTimes)
+
+		return progress
+
+def mapNpzArrays(fileName):
+	'''Memory maps every array of an uncompressed .npz file (as written by np.savez) in place, straight
+	from its offset in the zip file, so nothing is read until it's used.'''
+
+	arrays = {}
+
+	with zf.ZipFile(fileName) as npzFile, open(fileName, 'rb') as rawFile:
+		for info in npzFile.infolist():
+
+			if info.compress_type != zf.ZIP_STORED:
+				raise ValueError('%s is compressed and can not be memory mapped' % info.filename)
+
+			# Skip the local file header, whose extra field can differ from the central directory's
+			rawFile.seek(info.header_offset + 26)
+			nameLength, extraLength = np.frombuffer(rawFile.read(4), dtype='<u2')
+			rawFile.seek(info.header_offset + 30 + nameLength + extraLength)
+
+			version = np.lib.format.read_magic(rawFile)
+			if version == (1, 0):
+				shape, fortranOrder, dataType = np.lib.format.read_array_header_1_0(rawFile)
+			else:
+				shape, fortranOrder, dataType = np.lib.format.read_array_header_2_0(rawFile)
+
+			name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+			order = 'F' if fortranOrder else 'C'
+
+			if np.prod(shape) == 0:
+				arrays[name] = np.zeros(shape, dtype=dataType, order=order)
+			else:
+				arrays[name] = np.memmap(fileName, dtype=dataType, mode='r', offset=rawFile.tell(), shape=shape, order=order)
+
+	return arrays
+
+class TStatCache():
+	'''Least recently used cache of actual comparison t tests, for tStatNBS.tStatCache.  Entries are
+	keyed by the data series and a fingerprint of who is in each group, so comparing the same groups
+	again, e.g. at another threshold, doesn't redo the t test.  The groups the other way round hit the
+	same entry with the sign of the tstats flipped.  The least recently used entries are dropped once
+	the cached arrays take up more than maxBytes.  tStatNBS.cacheData empties it, as the key says
+	nothing about the data itself.'''
+
+	def __init__(self, maxBytes=256 * 2 ** 20):
+		self.maxBytes = maxBytes
+		self.currentBytes = 0
+		self.entries = cs.OrderedDict()
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def getKey(self, dataParameter, group1, group2):
+		'''Returns the cache key for a comparison and whether the groups are the other way round to it.'''
+
+		ids1 = sorted([str(sub.subjectId) for sub in group1])
+		ids2 = sorted([str(sub.subjectId) for sub in group2])
+
+		swapped = ids2 < ids1
+		if swapped:
+			ids1, ids2 = ids2, ids1
+
+		fingerprint = hl.sha1('\0'.join(ids1) + '\1' + '\0'.join(ids2)).hexdigest()
+
+		return (dataParameter.label, dataParameter.symmetric, dataParameter.totalNodes, fingerprint), swapped
+
+	def getResult(self, dataParameter, group1, group2):
+		'''Returns the cached TStatResult of a comparison, or None if it isn't cached.'''
+
+		key, swapped = self.getKey(dataParameter, group1, group2)
+
+		if not key in self.entries:
+			self.misses = self.misses + 1
+			return None
+
+		self.hits = self.hits + 1
+
+		# Move the entry to the most recently used end
+		cached = self.entries.pop(key)
+		self.entries[key] = cached
+
+		result = TStatResult()
+		result.tStats = -cached.tStats if swapped else cached.tStats
+		result.pVals = cached.pVals
+
+		return result
+
+	def addResult(self, dataParameter, group1, group2, result):
+
+		key, swapped = self.getKey(dataParameter, group1, group2)
+
+		cached = TStatResult()
+		cached.tStats = np.array(-result.tStats if swapped else result.tStats)
+		cached.pVals = np.array(result.pVals)
+
+		# Cached arrays are handed out as they are so keep them from being changed in place
+		cached.tStats.flags.writeable = False
+		cached.pVals.flags.writeable = False
+
+		size = cached.tStats.nbytes + cached.pVals.nbytes
+		if size > self.maxBytes:
+			return
+
+		if key in self.entries:
+			old = self.entries.pop(key)
+			self.currentBytes = self.currentBytes - old.tStats.nbytes - old.pVals.nbytes
+
+		self.entries[key] = cached
+		self.currentBytes = self.currentBytes + size
+
+		while self.currentBytes > self.maxBytes:
+			key, old = self.entries.popitem(last=False)
+			self.currentBytes = self.currentBytes - old.tStats.nbytes - old.pVals.nbytes
+			self.evictions = self.evictions + 1
+
+	def getStats(self):
+		'''Returns the hit, miss and eviction counts along with the entries and bytes held.'''
+
+		return {'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions,
+			'entries' : len(self.entries), 'bytes' : self.currentBytes, 'maxBytes' : self.maxBytes}
+
+	def clear(self):
+
+		self.entries.clear()
+		self.currentBytes = 0
+
+class ComparisonResult():
+	
+	def __init__(self):
+		self.actualResult = None
+		self.permutationResult = None
+		
+		# Number of permutations the p values are based on, fewer than asked for if stopped early
+		self.permutationsUsed = 0
+	
+	def save(self, fileName):
+		'''Writes the result to a single uncompressed .npz file: the suprathresh edges and component p
+		values of every actual graph plus the null distributions and node totals as typed arrays.'''
+		
+		graphs = [('series', key, graph) for key, graph in self.actualResult.dataSeriesGraphs.iteritems()]
+		graphs.extend([('threshold', key, graph) for key, graph in self.actualResult.thresholdGraphs.iteritems()])
+		
+		header = {'permutationsUsed' : self.permutationsUsed, 'graphs' : [(kind, key, graph.buildSubGraphs) for kind, key, graph in graphs]}
+		arrays = {}
+		
+		statistics = sorted(set([statistic for kind, key, graph in graphs for compnent in graph.components for statistic in compnent.pVals]))
+		header['statistics'] = statistics
+		
+		for idx, (kind, key, graph) in enumerate(graphs):
+			arrays['graph.%d.coords' % idx] = graph.coords.astype(np.int32)
+			arrays['graph.%d.pVals' % idx] = np.array([np.nan if compnent.pVal is None else compnent.pVal for compnent in graph.components], dtype=np.float64)
+			for statistic in statistics:
+				arrays['graph.%d.pVals.%s' % (idx, statistic)] = np.array([compnent.pVals.get(statistic, np.nan) for compnent in graph.components], dtype=np.float64)
+		
+		if self.permutationResult is not None:
+			
+			seriesKeys = sorted(self.permutationResult.extentsBySeries.keys())
+			header['seriesKeys'] = seriesKeys
+			
+			for idx, key in enumerate(seriesKeys):
+				arrays['extents.%d' % idx] = self.permutationResult.getSeriesExtents(key)[0:self.permutationResult.groupResultsLength]
+			arrays['overlapCounts'] = self.permutationResult.nodeOverlapCounts
+			arrays['nodeCounts'] = self.permutationResult.nodeCounts
+		
+		arrays['header'] = np.frombuffer(pk.dumps(header, pk.HIGHEST_PROTOCOL), dtype=np.uint8)
+		
+		with open(fileName, 'wb') as resultFile:
+			np.savez(resultFile, **arrays)
+	
+	@staticmethod
+	def load(fileName, mapNull=True):
+		'''Reads a result written by save.  The actual graphs are rebuilt from their edges, while the null
+		distributions are memory mapped from the file unless mapNull is False, so opening a result costs
+		next to nothing however many permutations it holds.'''
+		
+		if mapNull:
+			arrays = mapNpzArrays(fileName)
+		else:
+			with np.load(fileName) as npzFile:
+				arrays = dict((name, npzFile[name]) for name in npzFile.files)
+		
+		header = pk.loads(np.asarray(arrays['header']).tostring())
+		
+		result = ComparisonResult()
+		result.permutationsUsed = header['permutationsUsed']
+		result.actualResult = GroupResult()
+		
+		for idx, (kind, key, buildSubGraphs) in enumerate(header['graphs']):
+			
+			graph = Graph(buildSubGraphs)
+			graph.setCoords(np.asarray(arrays['graph.%d.coords' % idx]))
+			
+			# Components come back in the same order so the p values line up with them
+			for compnent, pVal in zip(graph.components, arrays['graph.%d.pVals' % idx]):
+				compnent.pVal = None if np.isnan(pVal) else float(pVal)
+			
+			for statistic in header.get('statistics', []):
+				for compnent, pVal in zip(graph.components, arrays['graph.%d.pVals.%s' % (idx, statistic)]):
+					if not np.isnan(pVal):
+						compnent.pVals[statistic] = float(pVal)
+			
+			if kind == 'series':
+				result.actualResult.dataSeriesGraphs[key] = graph
+			else:
+				result.actualResult.thresholdGraphs[key] = graph
+		
+		if 'seriesKeys' in header:
+			
+			permutationResult = PermutationResult()
+			permutationResult.groupResultsLength = permutationResult.capacity = len(arrays['overlapCounts'])
+			
+			# Mapped arrays are read only, adding permutations later on copies them out first
+			for idx, key in enumerate(header['seriesKeys']):
+				permutationResult.extentsBySeries[key] = arrays['extents.%d' % idx]
+			permutationResult.overlapCounts = arrays['overlapCounts']
+			permutationResult.nodeCounts = np.array(arrays['nodeCounts'])
+			
+			result.permutationResult = permutationResult
+		
+		return result
+
+class DataCacheItem():
+
+	def __init__(self):
+		self.subjectIndex = None
+		self.data = None
+
+		# Per edge sufficient statistics over every cached subject, used by the batched t-test
+		self.colMeans = None
+		self.colSumSq = None
+		self.constantCols = None
+
+	def computeStatistics(self, chunkSize=None):
+		'''Precomputes the column means and centered sums of squares of the cached data.  Both are
+		the same however the subjects are split into groups so they only need calculating once.  The
+		columns are worked through chunkSize at a time so an on disk cache never has to fit in memory.'''
+
+		edges = self.data.shape[1]
+		chunkSize = max(chunkSize or edges, 1)
+
+		self.colMeans = np.empty(edges)
+		self.colSumSq = np.empty(edges)
+		self.constantCols = np.empty(edges, dtype=bool)
+
+		for start in range(0, edges, chunkSize):
+
+			chunk = np.asarray(self.data[:, start:start + chunkSize], dtype=np.float64)
+
+			self.colMeans[start:start + chunkSize] = chunk.mean(axis=0)
+			self.colSumSq[start:start + chunkSize] = ((chunk - chunk.mean(axis=0)) ** 2).sum(axis=0)
+
+			# Columns with no variance (e.g. the diagonal of a correlation mtx) have no defined t stat
+			self.constantCols[start:start + chunkSize] = np.ptp(chunk, axis=0) == 0
+
+	def getColumns(self, start, stop):
+		'''Returns a cache item that views a range of this one's columns, data and statistics alike.'''
+
+		item = DataCacheItem()
+
+		item.subjectIndex = self.subjectIndex
+		item.data = self.data[:, start:stop]
+		item.colMeans = self.colMeans[start:stop]
+		item.colSumSq = self.colSumSq[start:stop]
+		item.constantCols = self.constantCols[start:stop]
+
+		return item
+
+	def getRows(self, rows, chunkSize=None):
+		'''Returns an in memory cache item holding just the given rows, with the statistics redone over
+		them, for t testing a pool of subjects that's only part of what was cached.'''
+
+		rows = np.asarray(rows)
+		subjectIds = dict((idx, subjectId) for subjectId, idx in self.subjectIndex.iteritems())
+
+		item = DataCacheItem()
+
+		item.subjectIndex = dict((subjectIds[row], idx) for idx, row in enumerate(rows))
+		item.data = np.asarray(self.data[rows])
+		item.computeStatistics(chunkSize)
+
+		return item
+
+	def saveCache(self, fileName, subjectIds, dataParameters, fingerprint):
+		'''Flushes an on disk cache and writes the subject list, data fingerprint and statistics that go
+		with it.'''
+
+		self.data.flush()
+
+		layout = [(parm.label, parm.symmetric, parm.totalNodes) for parm in dataParameters]
+
+		state = {'subjectIds' : subjectIds, 'layout' : layout, 'fingerprint' : fingerprint,
+			'colMeans' : self.colMeans, 'colSumSq' : self.colSumSq, 'constantCols' : self.constantCols}
+
+		with open(fileName + '.pkl', 'wb') as stateFile:
+			pk.dump(state, stateFile, pk.HIGHEST_PROTOCOL)
+
+	def loadCache(self, fileName, subjectIds, dataParameters, dataType, getFingerprint):
+		'''Maps a previously saved on disk cache straight back in instead of rebuilding it.  Returns
+		False if there isn't one or it was built from different subjects, settings or data.  The data is
+		checked against the cache's fingerprint, from getFingerprint(), only once everything else matches.'''
+
+		if not (os.path.exists(fileName) and os.path.exists(fileName + '.pkl')):
+			return False
+
+		with open(fileName + '.pkl', 'rb') as stateFile:
+			state = pk.load(stateFile)
+
+		layout = [(parm.label, parm.symmetric, parm.totalNodes) for parm in dataParameters]
+
+		if state['subjectIds'] != subjectIds or state.get('layout') != layout:
+			return False
+
+		data = np.load(fileName, mmap_mode='r')
+
+		if data.dtype != dataType:
+			return False
+
+		# The subjects' mtxs may have changed since, which takes reading them through once to tell
+		if state.get('fingerprint') != getFingerprint():
+			return False
+
+		self.data = data
+		self.colMeans = state['colMeans']
+		self.colSumSq = state['colSumSq']
+		self.constantCols = state['constantCols']
+		self.subjectIndex = dict((subjectId, idx) for idx, subjectId in enumerate(subjectIds))
+
+		return True
+
+class GLMModel():
+	'''General linear model t stats for a contrast of the design, with Freedman-Lane permutation: the
+	data is split into the part fitted by the nuisance regressors (the design reduced to the null space
+	of the contrast) plus its residuals, and only the residuals are permuted.
+
+	Both parts of a permuted t stat come from Q' P A, where A holds the nuisance model residuals, P is
+	the permutation and Q is an orthonormal basis of the design.  The contrast estimate is g' Q' P A
+	and the error sum of squares |A|^2 - |Q' P A|^2, the nuisance fit itself drops out of both, so a
+	block of permutations costs a single (K * rank) x n by n x edges mtx product.'''
+
+	def __init__(self, design, contrast):
+
+		self.design = np.asarray(design, dtype=np.float64)
+		self.contrast = np.asarray(contrast, dtype=np.float64).ravel()
+
+		n, regressors = self.design.shape
+
+		if len(self.contrast) != regressors:
+			raise ValueError('Contrast has %d weights for %d regressors' % (len(self.contrast), regressors))
+
+		# Nuisance regressors span the part of the design the contrast doesn't look at
+		nullBasis = np.linalg.svd(self.contrast[np.newaxis])[2][1:].T
+		nuisance = self.design.dot(nullBasis)
+		self.residualForming = np.eye(n) - nuisance.dot(np.linalg.pinv(nuisance))
+
+		# Orthonormal basis of the design and the contrast weights expressed in it
+		u, s, vt = np.linalg.svd(self.design, full_matrices=False)
+		rank = np.sum(s > s.max() * max(n, regressors) * np.finfo(np.float64).eps)
+
+		self.basis = u[:, 0:rank]
+		self.effectWeights = self.contrast.dot(np.linalg.pinv(self.design)).dot(self.basis)
+		self.varianceScale = self.contrast.dot(np.linalg.pinv(self.design.T.dot(self.design))).dot(self.contrast)
+		self.degreesOfFreedom = n - rank
+
+		# Nuisance model residuals of each cache item, keyed like the cache (None for a fused cache)
+		self.cacheItems = {}
+
+	def getIdentity(self):
+		'''Returns the permutation that leaves the data as it is, as a block of one.'''
+
+		return np.arange(self.design.shape[0])[np.newaxis]
+
+	def getRunLength(self, iterations, exact):
+		'''Residual permutations are always drawn at random, with replacement.'''
+
+		return iterations, False
+
+	def getPermutationLabels(self, iterations, seed, exact, blockSize):
+		'''Generates (blockStart, permutations) a block at a time, each block from its own RandomState
+		seeded from (seed, blockIndex).  Blocks are always full, see tStatNBS.getPermutationLabels.'''
+
+		n = self.design.shape[0]
+
+		for blockStart in range(0, iterations, blockSize):
+			random = np.random.RandomState([seed, blockStart // blockSize])
+			yield blockStart, np.array([random.permutation(n) for idx in range(blockSize)])
+
+	def addResiduals(self, key, dataCache, rows, chunkSize=None, fileName=None):
+		'''Stores the nuisance model residuals of the given cache rows, in design order, along with
+		their column sums of squares.  With a fileName they are kept in an on disk .npy file.'''
+
+		n, edges = len(rows), dataCache.data.shape[1]
+		chunkSize = max(chunkSize or edges, 1)
+
+		item = DataCacheItem()
+		item.subjectIndex = dict((idx, idx) for idx in range(n))
+
+		if fileName is not None:
+			item.data = np.lib.format.open_memmap(fileName, 'w+', dataCache.data.dtype, (n, edges))
+		else:
+			item.data = np.empty((n, edges), dtype=dataCache.data.dtype)
+
+		item.colSumSq = np.empty(edges)
+		item.constantCols = dataCache.constantCols
+
+		for start in range(0, edges, chunkSize):
+
+			residuals = self.residualForming.dot(np.asarray(dataCache.data[rows, start:start + chunkSize], dtype=np.float64))
+
+			item.data[:, start:start + chunkSize] = residuals
+			item.colSumSq[start:start + chunkSize] = (residuals ** 2).sum(axis=0)
+
+		self.cacheItems[key] = item
+
+	def tTestCache(self, permutations, residuals, chunkSize=None):
+		'''Computes the contrast t stats for a block of K permutations at once.  permutations is a K x n
+		array, design row i of a permutation gets residual row permutations[k, i].  The identity
+		permutation gives the t stats of the unpermuted data.  Returns a K x edges array.'''
+
+		permutations = np.asarray(permutations)
+		blockSize, n = permutations.shape
+		edges = residuals.data.shape[1]
+		rank = self.basis.shape[1]
+
+		# Q' P is Q with its rows put back through the inverse permutation, stack them for the block
+		inverse = np.argsort(permutations, axis=1)
+		mixing = self.basis[inverse].transpose(0, 2, 1).reshape((blockSize * rank, n)).astype(residuals.data.dtype)
+
+		chunkSize = max(chunkSize or edges, 1)
+		tStats = np.empty((blockSize, edges))
+
+		for start in range(0, edges, chunkSize):
+
+			stop = min(start + chunkSize, edges)
+
+			projected = mixing.dot(residuals.data[:, start:stop]).reshape((blockSize, rank, stop - start))
+
+			effects = np.einsum('r,kre->ke', self.effectWeights, projected)
+			errorSumSq = np.maximum(residuals.colSumSq[start:stop] - (projected ** 2).sum(axis=1), 0)
+
+			with np.errstate(divide='ignore', invalid='ignore'):
+				tStats[:, start:stop] = effects / np.sqrt(errorSumSq / self.degreesOfFreedom * self.varianceScale)
+
+		tStats[:, residuals.constantCols] = np.nan
+
+		return tStats
+
+class PairedModel():
+	'''Paired T test of within subject differences, e.g. pre vs post scans, with sign flipping: under
+	the null each difference is as likely to have either sign, so a permutation is a +-1 vector and a
+	block of them is t tested with a single K x n by n x edges mtx product.  Flipping every sign gives
+	the same |tstat| so only flip vectors with a + for the first pair are used.'''
+
+	def __init__(self, pairCount):
+
+		self.pairCount = pairCount
+
+		# Pair differences of each cache item, keyed like the cache (None for a fused cache)
+		self.cacheItems = {}
+
+	def getIdentity(self):
+		'''Returns the flip vector that leaves the differences as they are, as a block of one.'''
+
+		return np.ones((1, self.pairCount))
+
+	def getAssignmentCount(self):
+
+		return 2 ** (self.pairCount - 1)
+
+	def getRunLength(self, iterations, exact):
+		'''Like tStatNBS.getRunLength, every distinct flip vector is used once when there are no more of
+		them than iterations.'''
+
+		flipCount = self.getAssignmentCount()
+
+		if exact is None:
+			exact = flipCount <= iterations
+
+		if exact or iterations > flipCount:
+			iterations = flipCount
+
+		return iterations, exact
+
+	def getPermutationLabels(self, iterations, seed, exact, blockSize):
+		'''Generates the flip vectors of a run as (blockStart, signs) a block at a time.  Random blocks
+		draw from their own RandomState seeded from (seed, blockIndex) without repeating a flip vector,
+		exact blocks take the flips of the other pairs from the bits of each vector's rank.'''
+
+		n = self.pairCount
+		drawn = set()
+
+		for blockStart in range(0, iterations, blockSize):
+
+			count = min(blockSize, iterations - blockStart)
+
+			if exact:
+				ranks = np.arange(blockStart, blockStart + count)
+				flips = (ranks[:, np.newaxis] >> np.arange(n - 1)) & 1
+				yield blockStart, 1 - 2.0 * np.hstack((np.zeros((count, 1), dtype=int), flips))
+				continue
+
+			random = np.random.RandomState([seed, blockStart // blockSize])
+			signs = []
+
+			# Full blocks as far as there are flip vectors left, see tStatNBS.getPermutationLabels
+			count = min(blockSize, self.getAssignmentCount() - blockStart)
+
+			while len(signs) < count:
+
+				flips = random.randint(2, size=n).astype(bool)
+				if flips[0]:
+					flips = ~flips
+
+				key = np.packbits(flips).tostring()
+				if key in drawn:
+					continue
+
+				drawn.add(key)
+				signs.append(1 - 2.0 * flips)
+
+			yield blockStart, np.array(signs)
+
+	def addDifferences(self, key, dataCache, rows1, rows2, chunkSize=None, fileName=None):
+		'''Stores the differences between the cache rows of the first and second scan of each pair,
+		along with their column sums of squares.  With a fileName they are kept in an on disk .npy file.'''
+
+		edges = dataCache.data.shape[1]
+		chunkSize = max(chunkSize or edges, 1)
+
+		item = DataCacheItem()
+		item.subjectIndex = dict((idx, idx) for idx in range(self.pairCount))
+
+		if fileName is not None:
+			item.data = np.lib.format.open_memmap(fileName, 'w+', dataCache.data.dtype, (self.pairCount, edges))
+		else:
+			item.data = np.empty((self.pairCount, edges), dtype=dataCache.data.dtype)
+
+		item.colSumSq = np.empty(edges)
+		item.constantCols = np.empty(edges, dtype=bool)
+
+		for start in range(0, edges, chunkSize):
+
+			differences = np.asarray(dataCache.data[rows1, start:start + chunkSize], dtype=np.float64) - dataCache.data[rows2, start:start + chunkSize]
+
+			item.data[:, start:start + chunkSize] = differences
+			item.colSumSq[start:start + chunkSize] = (differences ** 2).sum(axis=0)
+
+			# Only differences that are all zero have no defined t stat, a constant nonzero difference
+			# is an infinite one, as for ss.ttest_rel, and varies once any of its signs are flipped
+			item.constantCols[start:start + chunkSize] = np.all(differences == 0, axis=0)
+
+		self.cacheItems[key] = item
+
+	def tTestCache(self, signs, differences, chunkSize=None):
+		'''Computes paired t stats for a block of K flip vectors at once, signs is a K x n array of +-1.
+		Returns a K x edges array of tStats matching ss.ttest_rel.'''
+
+		signs = np.asarray(signs)
+		blockSize, n = signs.shape
+		edges = differences.data.shape[1]
+
+		signs = signs.astype(differences.data.dtype)
+
+		chunkSize = max(chunkSize or edges, 1)
+		tStats = np.empty((blockSize, edges))
+
+		for start in range(0, edges, chunkSize):
+
+			stop = min(start + chunkSize, edges)
+
+			means = signs.dot(differences.data[:, start:stop]) / float(n)
+			sumSq = np.maximum(differences.colSumSq[start:stop] - n * means ** 2, 0)
+
+			with np.errstate(divide='ignore', invalid='ignore'):
+				tStats[:, start:stop] = means / np.sqrt(sumSq / (n - 1) / n)
+
+		tStats[:, differences.constantCols] = np.nan
+
+		return tStats
+
+def getCombinations(firstRank, count, n, k):
+	'''Returns count k-subsets of range(n) as a count x k array, starting at the subset with the given
+	rank in lexicographic order.  Lexicographic neighbours mostly differ by a single element.'''
+
+	# Unrank the first subset through the combinatorial number system
+	combination = []
+	x = 0
+	rank = firstRank
+	for slot in range(k):
+		while True:
+			following = sf.comb(n - x - 1, k - slot - 1, exact=True)
+			if rank < following:
+				break
+			rank = rank - following
+			x = x + 1
+		combination.append(x)
+		x = x + 1
+
+	combinations = np.empty((count, k), dtype=int)
+
+	for idx in range(count):
+
+		combinations[idx] = combination
+
+		# Step to the lexicographic successor
+		slot = k - 1
+		while slot >= 0 and combination[slot] == n - k + slot:
+			slot = slot - 1
+		if slot < 0:
+			break
+		combination[slot] = combination[slot] + 1
+		for following in range(slot + 1, k):
+			combination[following] = combination[following - 1] + 1
+
+	return combinations
+
+# Per process copy of the nbs object used by permutation workers, set up by initPermutationWorker
+workerNBS = None
+
+def initPermutationWorker(nbs, sharedData):
+	'''Pool initializer that rebuilds the data cache in a worker around the parent's shared memory,
+	or around the parent's cache files when the data is cached on disk.'''
+
+	global workerNBS
+
+	workerNBS = nbs
+
+	def attachData(shared):
+		if isinstance(shared, str):
+			return np.load(shared, mmap_mode='r')
+		else:
+			raw, dataType, shape = shared
+			return np.frombuffer(raw, dtype=dataType).reshape(shape)
+
+	if workerNBS.fusedCache is not None:
+		workerNBS.fusedCache.data = attachData(sharedData[None])
+		for label, (start, stop) in workerNBS.fusedOffsets.iteritems():
+			workerNBS.subDataByLabel[label].data = workerNBS.fusedCache.data[:, start:stop]
+	else:
+		for label, dci in workerNBS.subDataByLabel.iteritems():
+			dci.data = attachData(sharedData[label])
+
+	if workerNBS.model is not None:
+		for key, dci in workerNBS.model.cacheItems.iteritems():
+			dci.data = attachData(sharedData[('model', key)])
+
+def runPermutationBlock(args):
+	return workerNBS.getPermutationBlock(*args)
+
+def runShardTask(args):
+	workerNBS.getShard(*args[0:-1]).save(args[-1])
+	return args[-1]
+
+class tStatNBS():
+
+	def __init__(self, cacheDirectory=None, dataType=np.float64, edgeChunkSize=None, fuseSeries=False):
+		self.subDataByLabel = {}
+
+		# With fuseSeries every label is cached side by side in one mtx so each permutation block is
+		# t tested for all data series at once, subDataByLabel then holds column views of it
+		self.fuseSeries = fuseSeries
+		self.fusedCache = None
+		self.fusedOffsets = {}
+
+		# Number of permutations whose t stats are computed together in getRandomDistribution
+		self.permutationBlockSize = 100
+
+		# When set the subject data is cached in .npy files here and memory mapped instead of held in RAM
+		self.cacheDirectory = cacheDirectory
+
+		# Storage type of the cached data, np.float32 halves the footprint and the mtx product cost
+		self.dataType = np.dtype(dataType)
+
+		# Max # of edges t tested at once, bounds the temporaries to blockSize x edgeChunkSize
+		self.edgeChunkSize = edgeChunkSize
+
+		# Group assignments that differ from the one before by fewer than this fraction of the
+		# subjects (counting both sides of each swap) have their group sums updated, not recomputed.
+		# Off by default, a single BLAS product for the whole block is usually faster, see nbsbench
+		self.maxSwapFraction = 0.0
+
+		# RunObserver told about the progress of every permutation run, see RunObserver
+		self.observer = None
+
+		# Optional TStatCache that tTestGroups keeps its results in, off by default
+		self.tStatCache = None
+
+		# Component statistics given null distributions and p values, out of COMPONENT_STATISTICS.  They
+		# all come from the same pass over each permutation and the extent is always included
+		self.componentStatistics = ['extent']
+
+		# GLMModel or PairedModel of the comparison being run by compareGLM or comparePaired, with its
+		# own cached data, t test and permutations.  None for two group comparisons
+		self.model = None
+
+	def getCacheFileName(self, dataParameters):
+
+		name = '+'.join([str(parm.label) for parm in dataParameters])
+
+		return os.path.join(self.cacheDirectory, re.sub(r'[^\w.+-]', '_', name) + '.npy')
+	
+	def cacheData(self, group1, group2, dataParameters):
+
+		#if np.size(group1, axis=1) != np.size(group2, axis=1):
+		#	raise IndexError()
+		
+		# Any model was built over the data being replaced, the model comparisons set theirs up after
+		self.model = None
+		
+		# Cached t tests are keyed by who is in each group, not by their data, which may be different now
+		if self.tStatCache is not None:
+			self.tStatCache.clear()
+		
+		subs = []
+		subs.extend(group1)
+		subs.extend(group2)
+
+		if self.cacheDirectory is not None and not os.path.isdir(self.cacheDirectory):
+			os.makedirs(self.cacheDirectory)
+
+		self.fusedCache = None
+		self.fusedOffsets = {}
+
+		if self.fuseSeries:
+
+			# Cache every label in one mtx and give each its own view of the columns
+			self.fusedCache = self.cacheSeries(subs, dataParameters)
+
+			start = 0
+			for parm in dataParameters:
+
+				stop = start + parm.getEdgeCount()
+
+				self.subDataByLabel[parm.label] = self.fusedCache.getColumns(start, stop)
+				self.fusedOffsets[parm.label] = (start, stop)
+
+				start = stop
+		else:
+			for parm in dataParameters:
+				self.subDataByLabel[parm.label] = self.cacheSeries(subs, [parm])
+		return
+
+	def cacheSeries(self, subs, dataParameters):
+		'''Caches the flattened data of each subject for the given labels side by side in a single mtx.'''
+
+		subjectIds = [sub.subjectId for sub in subs]
+
+		def getRow(sub):
+			return np.concatenate([parm.flattenData(sub.data[parm.label]) for parm in dataParameters])
+
+		# On disk caches keep a hash of the data they were built from to tell when it has changed
+		def getFingerprint():
+			fingerprint = hl.sha1()
+			for sub in subs:
+				fingerprint.update(np.ascontiguousarray(getRow(sub), dtype=np.float64))
+			return fingerprint.hexdigest()
+
+		dci = DataCacheItem()
+		
+		dci.subjectIndex = {}
+		dci.data = None
+
+		fileName = None
+		if self.cacheDirectory is not None:
+
+			fileName = self.getCacheFileName(dataParameters)
+
+			# Reuse the on disk cache from an earlier run over the same subjects and data as is
+			if dci.loadCache(fileName, subjectIds, dataParameters, self.dataType, getFingerprint):
+				return dci
+
+		shape = (len(subs), sum([parm.getEdgeCount() for parm in dataParameters]))
+
+		if fileName is not None:
+			dci.data = np.lib.format.open_memmap(fileName, 'w+', self.dataType, shape)
+		else:
+			dci.data = np.empty(shape, dtype=self.dataType)
+		
+		fingerprint = hl.sha1()
+
+		for idx, sub in enumerate(subs):
+
+			row = getRow(sub)
+
+			dci.subjectIndex[sub.subjectId] = idx
+			dci.data[idx] = row
+
+			if fileName is not None:
+				fingerprint.update(np.ascontiguousarray(row, dtype=np.float64))
+
+		dci.computeStatistics(self.edgeChunkSize)
+
+		if fileName is not None:
+			dci.saveCache(fileName, subjectIds, dataParameters, fingerprint.hexdigest())
+
+		return dci
+				
+	def getSubjectData(self, subject, dataParameter):
+	
+		subDataKey = str(subject.subjectId) + dataParameter.label
+		
+		if self.cachedSubjectData.has_key(subDataKey):
+			return self.cachedSubjectData[subDataKey]
+		else:
+			dataItm = dataParameter.flattenData(subject.data[dataParameter.label])
+			self.cachedSubjectData[subDataKey] = dataItm
+			return dataItm
+			
+		
+	def tTestGroups(self, group1, group2, dataParameter):
+		'''This method takes two groups of subjects and compares their data by label and returns tStats and 
+		pVals for that label.  It flattens the data before comparing.'''
+
+		if self.tStatCache is not None:
+			result = self.tStatCache.getResult(dataParameter, group1, group2)
+			if result is not None:
+				return result
+
+		dataCache = self.subDataByLabel[dataParameter.label]
+		
+		# Look up the cache rows of each group
+		grp1 = []
+		for subject in group1:
+			dataIdx = dataCache.subjectIndex[subject.subjectId]
+			grp1.append(dataIdx)
+			
+		grp2 = []
+		for subject in group2:
+			dataIdx = dataCache.subjectIndex[subject.subjectId]
+			grp2.append(dataIdx)
+
+		n, edges = dataCache.data.shape
+		chunkSize = max(self.edgeChunkSize or edges, 1)
+	
+		result = TStatResult()
+		
+		# When the groups make up the whole cache, as they do in a comparison, the t stats are those of
+		# a block of one for the batched t test, which only ever holds a chunk of the edges in memory
+		if len(grp1) + len(grp2) == n and len(set(grp1 + grp2)) == n:
+			result.tStats = self.tTestCache(np.array([grp1]), dataCache)[0]
+		else:
+			result.tStats = np.empty(edges)
+			for start in range(0, edges, chunkSize):
+				result.tStats[start:start + chunkSize] = ss.ttest_ind(dataCache.data[grp1, start:start + chunkSize], dataCache.data[grp2, start:start + chunkSize], axis = 0)[0]
+		
+		# Two sided p values of the independent T test, a chunk at a time as well
+		result.pVals = np.empty(edges)
+		with np.errstate(invalid='ignore'):
+			for start in range(0, edges, chunkSize):
+				result.pVals[start:start + chunkSize] = 2 * ss.t.sf(np.abs(result.tStats[start:start + chunkSize]), len(grp1) + len(grp2) - 2)
+		
+		if self.tStatCache is not None:
+			self.tStatCache.addResult(dataParameter, group1, group2, result)
+		
+		return result
+
+	def tTestBatch(self, group1Rows, dataParameter):
+		'''Computes independent T test stats for a block of K group assignments at once.  group1Rows is
+		a K x n1 array of cache row indexes making up group 1 for each assignment, every other cached
+		subject is in group 2.  Returns a K x edges array of tStats matching ss.ttest_ind.'''
+
+		return self.tTestCache(group1Rows, self.subDataByLabel[dataParameter.label])
+
+	def tTestCache(self, group1Rows, dataCache):
+		'''Batched T test over every column of a cache item, see tTestBatch.'''
+
+		group1Rows = np.asarray(group1Rows)
+		blockSize, n1 = group1Rows.shape
+		n, edges = dataCache.data.shape
+		n2 = n - n1
+
+		# Build a K x n membership mtx so all of the group 1 sums come from a single mtx product
+		membership = np.zeros((blockSize, n), dtype=dataCache.data.dtype)
+		membership[np.arange(blockSize)[:, np.newaxis], group1Rows] = 1
+
+		scale = 1.0 / n1 + 1.0 / n2
+		chunkSize = max(self.edgeChunkSize or edges, 1)
+		tStats = np.empty((blockSize, edges))
+
+		schedule = self.getSwapSchedule(membership.astype(bool))
+
+		for start in range(0, edges, chunkSize):
+
+			stop = min(start + chunkSize, edges)
+
+			# Group 1 sums about the column means, the group 2 centered sums are just their negative
+			grp1Sums = self.getGroupSums(membership, dataCache.data[:, start:stop], schedule) - n1 * dataCache.colMeans[start:stop]
+
+			# Mean difference and pooled within group sum of squares from the fixed total sum of squares
+			meanDiff = grp1Sums * scale
+			withinSumSq = np.maximum(dataCache.colSumSq[start:stop] - grp1Sums ** 2 * scale, 0)
+
+			with np.errstate(divide='ignore', invalid='ignore'):
+				tStats[:, start:stop] = meanDiff / np.sqrt(withinSumSq / (n - 2) * scale)
+
+		tStats[:, dataCache.constantCols] = np.nan
+
+		return tStats
+
+	def getSwapSchedule(self, membership):
+		'''Orders a block of group assignments so each differs from the one before by as few subject
+		swaps as possible, greedily from the first.  Returns the visiting order, a flag for each
+		assignment whose sums have to be computed from scratch and, for the rest, the rows that joined
+		and left group 1 since the assignment visited before it.  The assignments themselves, and so
+		the sample they make up, are left as they are.'''
+
+		blockSize, n = membership.shape
+
+		if self.maxSwapFraction <= 0 or blockSize < 2:
+			return None
+
+		# Number of subjects that have to move between groups to get from one assignment to another
+		counts = membership.astype(int)
+		swaps = counts.sum(axis=1)[:, np.newaxis] - counts.dot(counts.T)
+
+		order = [0]
+		unvisited = np.ones(blockSize, dtype=bool)
+		unvisited[0] = False
+
+		for step in range(1, blockSize):
+			following = np.flatnonzero(unvisited)[np.argmin(swaps[order[-1], unvisited])]
+			order.append(following)
+			unvisited[following] = False
+
+		recompute = np.zeros(blockSize, dtype=bool)
+		recompute[order[0]] = True
+		joined = {}
+		left = {}
+
+		for previous, current in zip(order, order[1:]):
+			if 2 * swaps[previous, current] > self.maxSwapFraction * n:
+				recompute[current] = True
+			else:
+				joined[current] = np.flatnonzero(membership[current] & ~membership[previous])
+				left[current] = np.flatnonzero(membership[previous] & ~membership[current])
+
+		return order, recompute, joined, left
+
+	def getGroupSums(self, membership, data, schedule):
+		'''Sums the data of the group 1 rows of each assignment.  Without a schedule that's one mtx
+		product, with one only the assignments flagged for it are multiplied out and the rest are
+		updated from the assignment visited before them in O(swaps x edges).'''
+
+		if schedule is None:
+			return membership.dot(data)
+
+		order, recompute, joined, left = schedule
+
+		sums = np.empty((membership.shape[0], data.shape[1]))
+
+		direct = np.flatnonzero(recompute)
+		sums[direct] = membership[direct].dot(data)
+
+		for previous, current in zip(order, order[1:]):
+			if not recompute[current]:
+				sums[current] = sums[previous] + data[joined[current]].sum(axis=0, dtype=np.float64) - data[left[current]].sum(axis=0, dtype=np.float64)
+
+		return sums
+
+	def createGraph(self, tStats, dataParameter, buildSubGraphs=True, threshold=None):
+		'''Creates a graph made up of the links whose tstat is above the threshold of interest, by
+		default the primary threshold of the data series.  The networkx subgraphs for each component
+		can be skipped when only the component sizes matter.'''
+
+		if threshold is None:
+			threshold = dataParameter.getThresholds()[0]
+
+		# The suprathresh edges come straight from the flat tStats as index arrays
+		graph = Graph(buildSubGraphs)
+		graph.setEdges(*dataParameter.getSupraThreshEdges(tStats, threshold))
+
+		# Intensity statistics need the |tstat| of each distinct link, same as in the permutations
+		if 'intensity' in self.componentStatistics or 'maxT' in self.componentStatistics:
+			rows, cols, weights = dataParameter.getUndirectedEdges(tStats)
+			supraThresh = weights > threshold
+			graph.setEdgeWeights(rows[supraThresh], cols[supraThresh], weights[supraThresh])
+
+		return graph
+
+	def getStatistics(self):
+		'''Returns the component statistics to compute, the extent first.'''
+
+		for statistic in self.componentStatistics:
+			if statistic not in COMPONENT_STATISTICS:
+				raise ValueError('Unknown component statistic %s' % statistic)
+
+		return ['extent'] + [statistic for statistic in self.componentStatistics if statistic != 'extent']
+
+	def getNullKeys(self, dataParameters):
+		'''Returns the keys of every null distribution a run over the data series fills in.'''
+
+		return [getNullKey(key, statistic) for parm in dataParameters for key in parm.getSeriesKeys() for statistic in self.getStatistics()]
+
+	def getRunLayout(self, dataParameters):
+		'''Returns the settings the null distributions depend on beyond their keys: the thresholds, mtx
+		layout and node count of each data series and the type the data is cached as.  Checkpoints and
+		shards keep it to tell runs that can't be put together apart.'''
+
+		series = [(parm.label, [float(threshold) for threshold in parm.getThresholds()], parm.symmetric, parm.totalNodes) for parm in dataParameters]
+
+		return {'series' : series, 'dataType' : self.dataType.name}
+
+	def compareGroups(self, group1, group2, dataParameters):
+		'''Creates a graph for each data label that is made up of nodes that are above the thresh
+		tstat of interest.  Note:  group1 and group2 must be the same axis 1 length'''
+
+		result = GroupResult()
+
+		for dataParameter in dataParameters:
+
+			# Pull out the comparison result for this label
+			tresult = self.tTestGroups(group1, group2, dataParameter)
+
+			self.addSeriesGraphs(result, tresult.tStats, dataParameter)
+
+		return result
+
+	def addSeriesGraphs(self, result, tStats, dataParameter):
+		'''Adds the graph of a data series to a GroupResult, along with one for every threshold of a sweep.'''
+
+		result.addGraph(dataParameter, self.createGraph(tStats, dataParameter))
+
+		if dataParameter.isSweep():
+			for threshold in dataParameter.getThresholds():
+				result.addThresholdGraph(dataParameter, threshold, self.createGraph(tStats, dataParameter, True, threshold))
+
+	def getSharedCache(self):
+		'''Copies the cached data into shared memory and returns the pool initializer arguments that let
+		worker processes use it in place.  Data cached on disk is just mapped again by each worker, and
+		everything but the data itself is small and copied as is.'''
+
+		def shareData(data):
+			if isinstance(data, np.memmap):
+				return data.filename
+			else:
+				raw = mp.RawArray('b', data.nbytes)
+				np.frombuffer(raw, dtype=data.dtype).reshape(data.shape)[:] = data
+				return (raw, data.dtype, data.shape)
+
+		nbs = cp.copy(self)
+		nbs.subDataByLabel = {}
+		nbs.observer = None
+		nbs.tStatCache = None
+		sharedData = {}
+
+		# A fused cache is shared as a whole, the per label views get rebuilt from it in the worker
+		if self.fusedCache is not None:
+			sharedData[None] = shareData(self.fusedCache.data)
+			nbs.fusedCache = cp.copy(self.fusedCache)
+			nbs.fusedCache.data = None
+
+		for label, dci in self.subDataByLabel.iteritems():
+
+			if self.fusedCache is None:
+				sharedData[label] = shareData(dci.data)
+
+			item = cp.copy(dci)
+			item.data = None
+
+			nbs.subDataByLabel[label] = item
+
+		# A model t tests its own data, residuals or differences, so those get shared as well
+		if self.model is not None:
+			nbs.model = cp.copy(self.model)
+			nbs.model.cacheItems = {}
+
+			for key, dci in self.model.cacheItems.iteritems():
+				sharedData[('model', key)] = shareData(dci.data)
+
+				item = cp.copy(dci)
+				item.data = None
+
+				nbs.model.cacheItems[key] = item
+
+		return nbs, sharedData
+
+	@staticmethod
+	def getAssignmentCount(n, group1Size):
+		'''Returns the # of distinct group assignments of n subjects.  When both groups are the same size
+		an assignment and its mirror image give the same |tstat| so they only count once.'''
+
+		if 2 * group1Size == n:
+			return sf.comb(n - 1, group1Size - 1, exact=True)
+		else:
+			return sf.comb(n, group1Size, exact=True)
+
+	def getPermutationLabels(self, allRows, group1Size, iterations, seed, exact):
+		'''Generates the group 1 rows of every permutation as (blockStart, group1Rows) a block at a time.
+
+		Random blocks draw from their own RandomState seeded from (seed, blockIndex) and never repeat an
+		assignment already drawn, a set of packed membership bitmasks keeps track.  Exact blocks are
+		slices of the lexicographic enumeration of the distinct assignments instead.  Either way the
+		same arguments always give the same permutations, however the blocks are run afterwards.
+
+		The last random block is drawn in full, as far as there are assignments left, even when the run
+		ends part way through it.  The permutations used are the same, but the block is t tested just as
+		it would be in a longer run, so extending a run never changes the t stats of earlier ones.'''
+
+		# Models draw permutations of their own kind in place of group assignments
+		if self.model is not None:
+			for block in self.model.getPermutationLabels(iterations, seed, exact, self.permutationBlockSize):
+				yield block
+			return
+
+		n = len(allRows)
+		balanced = 2 * group1Size == n
+		drawn = set()
+
+		for blockStart in range(0, iterations, self.permutationBlockSize):
+
+			blockSize = min(self.permutationBlockSize, iterations - blockStart)
+
+			if exact:
+
+				# Balanced assignments are enumerated with the first subject always in group 1
+				if balanced:
+					combinations = getCombinations(blockStart, blockSize, n - 1, group1Size - 1) + 1
+					combinations = np.hstack((np.zeros((blockSize, 1), dtype=int), combinations))
+				else:
+					combinations = getCombinations(blockStart, blockSize, n, group1Size)
+
+				yield blockStart, allRows[combinations]
+				continue
+
+			random = np.random.RandomState([seed, blockStart // self.permutationBlockSize])
+			group1Rows = []
+
+			blockSize = min(self.permutationBlockSize, self.getAssignmentCount(n, group1Size) - blockStart)
+
+			while len(group1Rows) < blockSize:
+
+				# Mix up all of the subjects and grab a new group of the same size as the original
+				rows = random.permutation(n)[0:group1Size]
+
+				membership = np.zeros(n, dtype=bool)
+				membership[rows] = True
+				if balanced and not membership[0]:
+					membership = ~membership
+
+				key = np.packbits(membership).tostring()
+				if key in drawn:
+					continue
+
+				drawn.add(key)
+				group1Rows.append(rows)
+
+			yield blockStart, allRows[np.array(group1Rows)]
+
+	def getBlockTStats(self, group1Rows, dataParameters):
+		'''T tests every permutation of a block at once for each data series and returns the K x edges
+		tStats by label.  Under a model group1Rows holds that model's permutations instead.'''
+
+		def tTest(key, dataCache):
+			if self.model is not None:
+				return self.model.tTestCache(group1Rows, self.model.cacheItems[key], self.edgeChunkSize)
+			else:
+				return self.tTestCache(group1Rows, dataCache)
+
+		tStatsByLabel = {}
+		if self.fusedCache is not None:
+
+			# A single mtx product covers every data series, each label gets a view of its columns
+			tStats = tTest(None, self.fusedCache)
+			for dataParameter in dataParameters:
+				start, stop = self.fusedOffsets[dataParameter.label]
+				tStatsByLabel[dataParameter.label] = tStats[:, start:stop]
+		else:
+			for dataParameter in dataParameters:
+				tStatsByLabel[dataParameter.label] = tTest(dataParameter.label, self.subDataByLabel[dataParameter.label])
+
+		return tStatsByLabel
+
+	def getPermutationBlock(self, group1Rows, dataParameters, timed=False, keep=None):
+		'''Runs a block of permutations, given the group 1 cache rows of each, and returns them as a
+		PermutationResult.  When timed it returns the seconds spent in each stage and the bytes taken
+		up by the block's biggest arrays along with it, as (result, stageTimes, blockBytes).
+
+		keep is a slice of the block's permutations to return, e.g. at the ends of a shard.  The whole
+		block is still t tested so the t stats come out the same to the last bit however a run is split.'''
+
+		if timed:
+			stageTimes = dict((stage, 0.0) for stage in ['tTest', 'thresholding', 'components', 'accumulation'])
+			lapStart = ti.default_timer()
+
+		tStatsByLabel = self.getBlockTStats(group1Rows, dataParameters)
+
+		if keep is not None:
+			tStatsByLabel = dict((label, tStats[keep]) for label, tStats in tStatsByLabel.iteritems())
+
+		blockSize = len(tStatsByLabel.values()[0])
+		result = PermutationResult(blockSize, max([parm.totalNodes for parm in dataParameters]))
+
+		if timed:
+			lapEnd = ti.default_timer()
+			stageTimes['tTest'] = lapEnd - lapStart
+
+		totalNodes = max([parm.totalNodes for parm in dataParameters])
+		statistics = self.getStatistics()
+		extentsBySeries = dict((key, np.zeros(blockSize, dtype=getNullType(key))) for key in self.getNullKeys(dataParameters))
+		nodeMasks = np.zeros((blockSize, len(dataParameters), totalNodes), dtype=bool)
+
+		for i in range(blockSize):
+
+			# Only the largest component of each series is kept for the null distribution, so go
+			# straight from the t stats to its extent and nodes without building any graphs
+			for series, dataParameter in enumerate(dataParameters):
+
+				if timed:
+					lapStart = ti.default_timer()
+
+				rows, cols, weights = dataParameter.getUndirectedEdges(tStatsByLabel[dataParameter.label][i])
+
+				if timed:
+					lapEnd = ti.default_timer()
+					stageTimes['thresholding'] += lapEnd - lapStart
+
+				# Other statistics come out of the same components as the extent
+				if len(statistics) > 1:
+					values, nodeMask = findComponentStatistics(rows, cols, weights, dataParameter.getThresholds()[0], dataParameter.totalNodes, statistics)
+					for statistic in statistics:
+						extentsBySeries[getNullKey(dataParameter.label, statistic)][i] = values[statistic]
+				else:
+					extent, nodeMask = findLargestComponent(rows, cols, weights, dataParameter.getThresholds()[0], dataParameter.totalNodes)
+					extentsBySeries[dataParameter.label][i] = extent
+
+				nodeMasks[i, series, 0:len(nodeMask)] = nodeMask
+
+				# Sweeps get the largest extent at every threshold from a single pass over the edges
+				if dataParameter.isSweep():
+					thresholdExtents = findThresholdExtents(rows, cols, weights, dataParameter.getThresholds(), dataParameter.totalNodes)
+					for key, extent in zip(dataParameter.getSeriesKeys()[1:], thresholdExtents):
+						extentsBySeries[key][i] = extent
+
+					for idx, (threshold, key) in enumerate(zip(dataParameter.getThresholds(), dataParameter.getSeriesKeys()[1:])):
+						if len(statistics) > 1:
+
+							# The primary threshold's values are already there
+							if idx > 0:
+								values = findComponentStatistics(rows, cols, weights, threshold, dataParameter.totalNodes, statistics[1:])[0]
+
+							for statistic in statistics[1:]:
+								extentsBySeries[getNullKey(key, statistic)][i] = values[statistic]
+
+				if timed:
+					stageTimes['components'] += ti.default_timer() - lapEnd
+
+		if timed:
+			lapStart = ti.default_timer()
+
+		# Intersect the series of every permutation in the block at once and count the hits per node
+		overlap = findNodeOverlap(nodeMasks)
+		result.addPermutations(extentsBySeries, overlap.sum(axis=1), overlap.sum(axis=0))
+
+		if timed:
+			stageTimes['accumulation'] = ti.default_timer() - lapStart
+			blockBytes = sum([tStats.nbytes for tStats in tStatsByLabel.values()]) + nodeMasks.nbytes
+			return result, stageTimes, blockBytes
+
+		return result
+
+	def getSubjectRows(self, group1, group2, dataParameters):
+		'''Returns the cache rows of group 1 followed by those of group 2.'''
+
+		# Every label is cached in the same subject order so any of them gives us the row lookup
+		subjectIndex = self.subDataByLabel[dataParameters[0].label].subjectIndex
+
+		return np.array([subjectIndex[sub.subjectId] for sub in list(group1) + list(group2)])
+
+	def getRunLength(self, n, group1Size, iterations, exact):
+		'''Works out how many permutations a run really does and whether they're enumerated exactly,
+		which happens on its own when there are no more distinct assignments than iterations.'''
+
+		assignmentCount = self.getAssignmentCount(n, group1Size)
+
+		if exact is None:
+			exact = assignmentCount <= iterations
+
+		# There's no point going past the number of distinct assignments, either way
+		if exact or iterations > assignmentCount:
+			iterations = assignmentCount
+
+		return iterations, exact
+
+	def runPermutationRange(self, allRows, group1Size, dataParameters, iterations, seed, exact, start, stop, result, workers=1, checkpoint=None, stoppingRule=None, actualResult=None):
+		'''Runs permutations start to stop of the run of the given length and seed, appending them to
+		result.  Blocks before start are still generated so the drawn assignments carry on the same way,
+		which is what lets any range of a run be done separately and merged back together.'''
+
+		# Exact runs enumerate the assignments in order, a prefix of which isn't a random sample of them,
+		# so they can't be stopped early and always go through every one
+		if exact:
+			stoppingRule = None
+
+		observer = self.observer
+		timed = observer is not None
+
+		def getTasks():
+			for blockStart, group1Rows in self.getPermutationLabels(allRows, group1Size, iterations, seed, exact):
+				if blockStart >= stop:
+					return
+				if blockStart + len(group1Rows) > start:
+					yield group1Rows, dataParameters, timed, slice(max(start - blockStart, 0), stop - blockStart)
+
+		blockCount = len(range(start - start % self.permutationBlockSize, stop, self.permutationBlockSize))
+
+		pool = None
+		if workers > 1 and blockCount > 1:
+			pool = mp.Pool(min(workers, blockCount), initPermutationWorker, self.getSharedCache())
+			blockResults = pool.imap(runPermutationBlock, getTasks(), 1)
+		else:
+			blockResults = (self.getPermutationBlock(*task) for task in getTasks())
+
+		if timed:
+			if self.model is not None:
+				cacheItems = self.model.cacheItems.values()
+			elif self.fusedCache is not None:
+				cacheItems = [self.fusedCache]
+			else:
+				cacheItems = self.subDataByLabel.values()
+
+			progress = RunProgress(result.groupResultsLength, iterations, sum([dci.data.nbytes for dci in cacheItems]))
+			observer.runStarted(progress.update(result.groupResultsLength))
+
+		try:
+			# Merge the blocks back in order so the result doesn't depend on which worker ran what
+			for blockResult in blockResults:
+
+				if timed:
+					blockResult, blockTimes, blockBytes = blockResult
+
+					lapStart = ti.default_timer()
+					result.merge(blockResult)
+					blockTimes['accumulation'] += ti.default_timer() - lapStart
+
+					observer.blockFinished(progress.update(result.groupResultsLength, blockTimes, blockBytes))
+				else:
+					result.merge(blockResult)
+
+				if checkpoint is not None and result.groupResultsLength - checkpoint.savedLength >= checkpoint.interval:
+					checkpoint.save(result)
+
+				if stoppingRule is not None and stoppingRule.isResolved(result, actualResult, self.getStatistics()):
+					break
+		finally:
+			if pool is not None:
+				pool.terminate()
+				pool.join()
+
+		if timed:
+			observer.runFinished(progress.update(result.groupResultsLength))
+
+		return result
+
+	def getRandomDistribution(self, group1, group2, dataParameters, iterations, seed=None, workers=1, checkpoint=None, stoppingRule=None, actualResult=None, exact=None):
+		'''Builds the null distribution from random group assignments drawn without replacement.  The
+		same seed always gives the same result, independent of the number of worker processes the blocks
+		are spread over.  With a PermutationCheckpoint the run resumes from, and extends, whatever the
+		checkpoint already holds.  With a stopping rule and the actual result a random run ends as soon as
+		the rule is satisfied.  When there are no more distinct assignments than iterations (or exact is
+		True) every distinct assignment is used once instead.'''
+
+		# The rule scores the actual components as it goes so it can't do without them
+		if stoppingRule is not None and actualResult is None:
+			raise ValueError('A stopping rule needs the actual result to score against')
+
+		# Two group runs never go through a model left over from compareGLM or comparePaired
+		self.model = None
+
+		if seed is None:
+			seed = np.random.randint(2 ** 31 - 1)
+
+		iterations, exact = self.getRunLength(len(group1) + len(group2), len(group1), iterations, exact)
+
+		result = PermutationResult(iterations, max([parm.totalNodes for parm in dataParameters]))
+		completed = 0
+
+		if checkpoint is not None:
+			seriesKeys = self.getNullKeys(dataParameters)
+			subjectIds = [sub.subjectId for sub in list(group1) + list(group2)]
+			seed = checkpoint.start(seed, self.permutationBlockSize, seriesKeys, (len(group1), len(group2)), exact, subjectIds, self.getRunLayout(dataParameters))
+			completed = checkpoint.resume(result, iterations)
+
+		# Put all subjects together for easy shuffling
+		allRows = self.getSubjectRows(group1, group2, dataParameters)
+
+		# Run whatever is left of the desired # of iterations
+		self.runPermutationRange(allRows, len(group1), dataParameters, iterations, seed, exact, completed, iterations, result, workers, checkpoint, stoppingRule, actualResult)
+
+		if checkpoint is not None and result.groupResultsLength > checkpoint.savedLength:
+			checkpoint.save(result)
+
+		# Return the permutation results
+		return result
+
+	def getShard(self, allRows, group1Size, dataParameters, iterations, seed, exact, start, stop, subjectIds):
+		'''Runs permutations start to stop of a run over already cached data and returns them as a shard.
+		The subject ids, in the order of allRows, and the run layout go into the run info so shards of
+		different cohorts or settings never get merged.'''
+
+		result = PermutationResult(stop - start, max([parm.totalNodes for parm in dataParameters]))
+		self.runPermutationRange(allRows, group1Size, dataParameters, iterations, seed, exact, start, stop, result)
+
+		runInfo = {'seed' : seed, 'iterations' : iterations, 'exact' : exact, 'blockSize' : self.permutationBlockSize,
+			'groupSizes' : (group1Size, len(allRows) - group1Size), 'seriesKeys' : self.getNullKeys(dataParameters), 'subjectIds' : list(subjectIds),
+			'layout' : self.getRunLayout(dataParameters)}
+
+		return PermutationShard(start, stop, runInfo, result)
+
+	def runShard(self, group1, group2, dataParameters, iterations, seed, start, stop, fileName=None, exact=None):
+		'''Runs permutations start to stop of a run of the given length and seed, e.g. on one node of a
+		cluster, optionally writing the shard to fileName.  Merging shards that cover the whole run with
+		PermutationShard.merge gives the same PermutationResult as getRandomDistribution.'''
+
+		self.cacheData(group1, group2, dataParameters)
+
+		iterations, exact = self.getRunLength(len(group1) + len(group2), len(group1), iterations, exact)
+
+		subjectIds = [sub.subjectId for sub in list(group1) + list(group2)]
+		shard = self.getShard(self.getSubjectRows(group1, group2, dataParameters), len(group1), dataParameters, iterations, seed, exact, min(start, iterations), min(stop, iterations), subjectIds)
+
+		if fileName is not None:
+			shard.save(fileName)
+
+		return shard
+
+	def runLocalShards(self, group1, group2, dataParameters, iterations, seed, shardCount, directory, exact=None):
+		'''Stands in for a cluster by running a whole run as shardCount shards over a local process pool.
+		Each shard is written to directory and the list of shard files is returned.'''
+
+		self.cacheData(group1, group2, dataParameters)
+
+		iterations, exact = self.getRunLength(len(group1) + len(group2), len(group1), iterations, exact)
+		allRows = self.getSubjectRows(group1, group2, dataParameters)
+		subjectIds = [sub.subjectId for sub in list(group1) + list(group2)]
+
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+		tasks = []
+		for shard in range(shardCount):
+			start = shard * iterations // shardCount
+			stop = (shard + 1) * iterations // shardCount
+			fileName = os.path.join(directory, 'shard.%d.npz' % shard)
+			tasks.append((allRows, len(group1), dataParameters, iterations, seed, exact, start, stop, subjectIds, fileName))
+
+		pool = mp.Pool(shardCount, initPermutationWorker, self.getSharedCache())
+		try:
+			return pool.map(runShardTask, tasks, 1)
+		finally:
+			pool.terminate()
+			pool.join()
+
+	def compare(self, group1, group2, dataParameters, iterations, workers=1, seed=None, checkpoint=None, stoppingRule=None, exact=None):
+
+		result = ComparisonResult()
+
+		self.cacheData(group1, group2, dataParameters)
+		
+		# Compare groups for actual labels
+		result.actualResult = self.compareGroups(group1, group2, dataParameters)
+			
+		# Generate group comparisons based on random group assignments
+		result.permutationResult = self.getRandomDistribution(group1, group2, dataParameters, iterations, seed, workers, checkpoint, stoppingRule, result.actualResult, exact)
+		result.permutationsUsed = result.permutationResult.groupResultsLength
+
+		self.setComponentPVals(result)
+
+		return result
+
+	def compareBatch(self, contrasts, dataParameters, iterations, workers=1, seed=None, exact=None):
+		'''Runs several group contrasts, given as (group1, group2) pairs, over a single data cache of
+		every subject they use.  Contrasts over the same pool of subjects share that pool's statistics,
+		and those whose group sizes match either way round share a single null distribution, as the
+		group 1 / group 2 split doesn't change |tstat|.  Returns a ComparisonResult per contrast.'''
+
+		if seed is None:
+			seed = np.random.randint(2 ** 31 - 1)
+
+		# Cache the union of the subjects once, in order of first appearance
+		subjects = []
+		subjectIds = set()
+		for group1, group2 in contrasts:
+			for sub in list(group1) + list(group2):
+				if sub.subjectId not in subjectIds:
+					subjectIds.add(sub.subjectId)
+					subjects.append(sub)
+
+		self.cacheData(subjects, [], dataParameters)
+
+		subjectIndex = self.subDataByLabel[dataParameters[0].label].subjectIndex
+
+		pools = cs.OrderedDict()
+		for idx, (group1, group2) in enumerate(contrasts):
+			pool = frozenset([sub.subjectId for sub in list(group1) + list(group2)])
+			pools.setdefault(pool, []).append(idx)
+
+		results = [None] * len(contrasts)
+
+		for pool, indexes in pools.iteritems():
+
+			poolNBS = self.getPoolCache(sorted([subjectIndex[subjectId] for subjectId in pool]))
+			nullsBySize = {}
+
+			for idx in indexes:
+
+				group1, group2 = contrasts[idx]
+
+				result = ComparisonResult()
+				result.actualResult = poolNBS.compareGroups(group1, group2, dataParameters)
+
+				# Draw the null for the smaller group so a contrast and its mirror image share it
+				if len(group1) > len(group2):
+					group1, group2 = group2, group1
+
+				if len(group1) not in nullsBySize:
+					nullsBySize[len(group1)] = poolNBS.getRandomDistribution(group1, group2, dataParameters, iterations, seed, workers, exact=exact)
+
+				result.permutationResult = nullsBySize[len(group1)]
+				result.permutationsUsed = result.permutationResult.groupResultsLength
+
+				self.setComponentPVals(result)
+				results[idx] = result
+
+		return results
+
+	def getPoolCache(self, rows):
+		'''Returns a copy of this object whose cache only holds the given rows, or this object itself
+		when they're all of the cached rows.  The copy shares everything but the cached data.'''
+
+		if len(rows) == len(self.subDataByLabel.values()[0].data):
+			return self
+
+		nbs = cp.copy(self)
+		nbs.subDataByLabel = {}
+
+		if self.fusedCache is not None:
+			nbs.fusedCache = self.fusedCache.getRows(rows, self.edgeChunkSize)
+			for label, (start, stop) in self.fusedOffsets.iteritems():
+				nbs.subDataByLabel[label] = nbs.fusedCache.getColumns(start, stop)
+		else:
+			for label, dci in self.subDataByLabel.iteritems():
+				nbs.subDataByLabel[label] = dci.getRows(rows, self.edgeChunkSize)
+
+		return nbs
+
+	def compareGLM(self, subjects, design, contrast, dataParameters, iterations, workers=1, seed=None, checkpoint=None, stoppingRule=None):
+		'''Tests a contrast of a general linear model, e.g. a group difference adjusted for age and sex,
+		in place of the plain two group T test.  design is a subjects x regressors mtx, in the order of
+		subjects, and contrast has one weight per regressor.  The null distribution comes from Freedman-
+		Lane permutation of the nuisance model residuals, drawn with replacement from seed.  Returns the
+		same ComparisonResult as compare.'''
+
+		design = np.asarray(design, dtype=np.float64)
+		if design.ndim != 2 or design.shape[0] != len(subjects):
+			raise ValueError('Design needs one row per subject')
+
+		self.cacheData(subjects, [], dataParameters)
+
+		rows = self.getSubjectRows(subjects, [], dataParameters)
+		self.model = GLMModel(design, contrast)
+
+		# Residualise the cached data against the nuisance regressors once, up front
+		for key, dataCache, fileName in self.getModelCacheItems(dataParameters, 'residuals'):
+			self.model.addResiduals(key, dataCache, rows, self.edgeChunkSize, fileName)
+
+		return self.compareModel(dataParameters, iterations, workers, seed, checkpoint, stoppingRule, None, ('glm',) + design.shape,
+			[sub.subjectId for sub in subjects])
+
+	def comparePaired(self, group1, group2, dataParameters, iterations, workers=1, seed=None, checkpoint=None, stoppingRule=None, exact=None):
+		'''Paired comparison of two scans per subject, group1[i] and group2[i] being the pair of the ith
+		subject.  The differences are cached once and the null distribution comes from sign flipping
+		them, drawn without replacement from seed, or every distinct flip when there are no more than
+		iterations (or exact is True).  Returns the same ComparisonResult as compare.'''
+
+		if len(group1) != len(group2):
+			raise ValueError('Paired groups need the same # of subjects')
+
+		self.cacheData(group1, group2, dataParameters)
+
+		rows1 = self.getSubjectRows(group1, [], dataParameters)
+		rows2 = self.getSubjectRows(group2, [], dataParameters)
+		self.model = PairedModel(len(group1))
+
+		for key, dataCache, fileName in self.getModelCacheItems(dataParameters, 'differences'):
+			self.model.addDifferences(key, dataCache, rows1, rows2, self.edgeChunkSize, fileName)
+
+		return self.compareModel(dataParameters, iterations, workers, seed, checkpoint, stoppingRule, exact, ('paired', len(group1)),
+			[sub.subjectId for sub in list(group1) + list(group2)])
+
+	def getModelCacheItems(self, dataParameters, suffix):
+		'''Returns the key, cache item and, with a cache directory, the file name of the model's own
+		copy of each cached mtx.'''
+
+		if self.fusedCache is not None:
+			items = [(None, self.fusedCache, dataParameters)]
+		else:
+			items = [(parm.label, self.subDataByLabel[parm.label], [parm]) for parm in dataParameters]
+
+		modelItems = []
+		for key, dataCache, parms in items:
+			fileName = None
+			if self.cacheDirectory is not None:
+				fileName = '%s.%s.npy' % (self.getCacheFileName(parms)[:-len('.npy')], suffix)
+			modelItems.append((key, dataCache, fileName))
+
+		return modelItems
+
+	def compareModel(self, dataParameters, iterations, workers, seed, checkpoint, stoppingRule, exact, runShape, subjectIds):
+		'''Runs the comparison of the current model once its data is cached.  runShape and the subject
+		ids, in the order of the model's rows, tell runs of different models apart in a checkpoint.'''
+
+		result = ComparisonResult()
+
+		# The actual t stats are those of the model's identity permutation
+		tStatsByLabel = self.getBlockTStats(self.model.getIdentity(), dataParameters)
+
+		result.actualResult = GroupResult()
+		for dataParameter in dataParameters:
+			self.addSeriesGraphs(result.actualResult, tStatsByLabel[dataParameter.label][0], dataParameter)
+
+		if seed is None:
+			seed = np.random.randint(2 ** 31 - 1)
+
+		iterations, exact = self.model.getRunLength(iterations, exact)
+
+		permutationResult = PermutationResult(iterations, max([parm.totalNodes for parm in dataParameters]))
+		completed = 0
+
+		if checkpoint is not None:
+			seriesKeys = self.getNullKeys(dataParameters)
+			seed = checkpoint.start(seed, self.permutationBlockSize, seriesKeys, runShape, exact, subjectIds, self.getRunLayout(dataParameters))
+			completed = checkpoint.resume(permutationResult, iterations)
+
+		self.runPermutationRange(None, None, dataParameters, iterations, seed, exact, completed, iterations, permutationResult, workers, checkpoint, stoppingRule, result.actualResult)
+
+		if checkpoint is not None and permutationResult.groupResultsLength > checkpoint.savedLength:
+			checkpoint.save(permutationResult)
+
+		result.permutationResult = permutationResult
+		result.permutationsUsed = permutationResult.groupResultsLength
+
+		self.setComponentPVals(result)
 
 		return result
+
+	def setComponentPVals(self, result):
+		'''Calculates p values for the components of each data series and threshold of a ComparisonResult.'''
+
+		for label, graph in result.actualResult.getSeriesGraphs().iteritems():
+			for statistic in self.getStatistics():
+
+				pVals = result.permutationResult.getComponentPVals(getNullKey(label, statistic), graph.getComponentStatistic(statistic))
+				for compnent, pVal in zip(graph.components, pVals):
+					compnent.pVals[statistic] = float(pVal)
+
+			for compnent in graph.components:
+				compnent.pVal = compnent.pVals['extent']
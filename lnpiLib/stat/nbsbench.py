@@ -0,0 +1,191 @@
+#    This program is part of the University of Minnesota Labratory for
+#    NeuroPsychiatric Imaging ToolKit
+#
+#    LNPITK is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Copyright 2011 Brent Nelson
+
+import argparse as ap
+import datetime as dt
+import json as js
+import platform as pf
+import sys as sys
+import timeit as ti
+import numpy as np
+import scipy as sc
+import lnpiLib.stat.nbs as nbs
+
+#Benchmark harness for the NBS pipeline.  Runs tStatNBS over synthetic cohorts with a planted effect
+#network and times each stage on its own, writing the timings out as JSON so runs on different
+#versions of the code can be compared.  Needs nothing beyond what nbs itself does.
+#
+#	python -m lnpiLib.stat.nbsbench --nodes 90 --subjects 40 --iterations 1000 --output bench.json
+#
+#The incremental group sums of tStatNBS.maxSwapFraction only pay off, if at all, on exact runs with few
+#subjects, where each enumerated assignment is a swap or two away from the one before, e.g.
+#
+#	python -m lnpiLib.stat.nbsbench --nodes 264 --subjects 16 --iterations 12870 --exact --max-swap-fraction 0 0.25
+
+class SyntheticSubject():
+
+	def __init__(self, subjectId, data):
+		self.subjectId = subjectId
+		self.data = data
+
+def makeCohort(subjectCount, totalNodes, labels, effectNodes, effectSize, seed=0):
+	'''Makes two groups of subjects with symmetric random connectivity mtxs for each label.  The edges
+	between the first effectNodes nodes are raised by effectSize in group 1, planting a single effect
+	network for the comparison to find.'''
+
+	random = np.random.RandomState(seed)
+	group1Size = (subjectCount + 1) // 2
+
+	subjects = []
+	for idx in range(subjectCount):
+
+		data = {}
+		for label in labels:
+
+			mtx = random.randn(totalNodes, totalNodes)
+			mtx = (mtx + mtx.T) / 2.0
+			np.fill_diagonal(mtx, 1.0)
+
+			if idx < group1Size:
+				mtx[0:effectNodes, 0:effectNodes] += effectSize
+
+			data[label] = mtx
+
+		subjects.append(SyntheticSubject('subject%d' % idx, data))
+
+	return subjects[0:group1Size], subjects[group1Size:]
+
+def timeStage(timings, stage, func, *args):
+	'''Calls func(*args), adds the time it took to the stage's total and returns what it returned.'''
+
+	start = ti.default_timer()
+	result = func(*args)
+	timings[stage] = timings.get(stage, 0.0) + ti.default_timer() - start
+
+	return result
+
+def setGraphEdges(edges):
+
+	graph = nbs.Graph()
+	graph.setEdges(*edges)
+
+	return graph
+
+def runBenchmark(totalNodes=90, subjectCount=40, seriesCount=1, iterations=1000, threshold=3.0, symmetric=True,
+		effectNodes=10, effectSize=1.0, seed=0, workers=1, nbsOptions=None, exact=None, maxSwapFraction=0.0):
+	'''Runs the pipeline over one synthetic cohort and returns a dict of the settings, the seconds spent
+	in each stage and whether the planted network came out significant.
+
+	The stages of a single comparison (cacheData, tTestGroups, thresholding, Graph.setEdges as setCoords and
+	PermutationResult.addResult) are timed on their own, as is the permutation run and compare as a
+	whole.  nbsOptions are passed on to tStatNBS, e.g. fuseSeries or dataType.  exact and maxSwapFraction
+	are passed on to the permutation run, e.g. to compare the incremental group sums of an exact run
+	with recomputing them.'''
+
+	nbsOptions = dict(nbsOptions or {})
+	labels = ['series%d' % idx for idx in range(seriesCount)]
+	dataParameters = [nbs.DataParameters(label, threshold, totalNodes, symmetric) for label in labels]
+
+	group1, group2 = makeCohort(subjectCount, totalNodes, labels, effectNodes, effectSize, seed)
+
+	timings = {}
+	tStat = nbs.tStatNBS(**nbsOptions)
+	tStat.maxSwapFraction = maxSwapFraction
+
+	timeStage(timings, 'cacheData', tStat.cacheData, group1, group2, dataParameters)
+
+	# One comparison taken apart stage by stage
+	groupResult = nbs.GroupResult()
+	for dataParameter in dataParameters:
+		tResult = timeStage(timings, 'tTestGroups', tStat.tTestGroups, group1, group2, dataParameter)
+		edges = timeStage(timings, 'thresholding', dataParameter.getSupraThreshEdges, tResult.tStats, dataParameter.getThresholds()[0])
+		graph = timeStage(timings, 'setCoords', setGraphEdges, edges)
+		groupResult.addGraph(dataParameter, graph)
+
+	permutationResult = nbs.PermutationResult(1, totalNodes)
+	timeStage(timings, 'addResult', permutationResult.addResult, groupResult)
+
+	# Then the null distribution and the whole comparison, which caches the data over again
+	nullResult = timeStage(timings, 'permutations', tStat.getRandomDistribution, group1, group2, dataParameters, iterations, seed, workers, None, None, None, exact)
+	comparison = timeStage(timings, 'compare', tStat.compare, group1, group2, dataParameters, iterations, workers, seed, None, None, exact)
+
+	# The planted network is found if the component holding its nodes is significant for every series
+	pVals = []
+	for label, graph in comparison.actualResult.dataSeriesGraphs.iteritems():
+		pVals.extend([component.pVal for component in graph.components if 0 in component.nodes()])
+
+	settings = {'totalNodes' : totalNodes, 'subjectCount' : subjectCount, 'seriesCount' : seriesCount,
+		'iterations' : iterations, 'threshold' : threshold, 'symmetric' : symmetric, 'effectNodes' : effectNodes,
+		'effectSize' : effectSize, 'seed' : seed, 'workers' : workers, 'exact' : exact, 'maxSwapFraction' : maxSwapFraction,
+		'nbsOptions' : dict((name, np.dtype(value).name if name == 'dataType' else value) for name, value in nbsOptions.iteritems())}
+
+	return {'settings' : settings, 'timings' : timings,
+		'permutationsPerSecond' : nullResult.groupResultsLength / max(timings['permutations'], 1e-9),
+		'effectPVals' : pVals, 'effectFound' : len(pVals) == seriesCount and max(pVals) < 0.05}
+
+def getEnvironment():
+	'''Returns what the timings depend on besides the settings, to keep alongside them.'''
+
+	return {'date' : dt.datetime.now().isoformat(), 'python' : pf.python_version(), 'numpy' : np.__version__,
+		'scipy' : sc.__version__, 'machine' : pf.machine(), 'platform' : pf.platform(), 'processor' : pf.processor()}
+
+def main(argv=None):
+
+	parser = ap.ArgumentParser(description='Times the stages of the NBS pipeline over synthetic cohorts.')
+	parser.add_argument('--nodes', type=int, nargs='+', default=[90], help='node counts to run, one benchmark each')
+	parser.add_argument('--subjects', type=int, default=40)
+	parser.add_argument('--series', type=int, default=1)
+	parser.add_argument('--iterations', type=int, default=1000)
+	parser.add_argument('--threshold', type=float, default=3.0)
+	parser.add_argument('--full', action='store_true', help='test full mtxs instead of the upper triangle')
+	parser.add_argument('--effect-nodes', type=int, default=10)
+	parser.add_argument('--effect-size', type=float, default=1.0)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--workers', type=int, default=1)
+	parser.add_argument('--repeat', type=int, default=1, help='runs per node count, the fastest time of each stage is kept')
+	parser.add_argument('--fuse', action='store_true', help='fuse every series into one cache')
+	parser.add_argument('--float32', action='store_true', help='cache the data as float32')
+	parser.add_argument('--edge-chunk', type=int, default=None)
+	parser.add_argument('--exact', action='store_true', default=None, help='enumerate every group assignment, e.g. with few subjects')
+	parser.add_argument('--max-swap-fraction', type=float, nargs='+', default=[0.0], help='incremental group sum settings to run, one benchmark each, 0 recomputes every block')
+	parser.add_argument('--output', default=None, help='JSON file to write, standard out by default')
+	args = parser.parse_args(argv)
+
+	nbsOptions = {'fuseSeries' : args.fuse, 'dataType' : np.float32 if args.float32 else np.float64, 'edgeChunkSize' : args.edge_chunk}
+
+	runs = []
+	for totalNodes in args.nodes:
+		for maxSwapFraction in args.max_swap_fraction:
+
+			repeats = [runBenchmark(totalNodes, args.subjects, args.series, args.iterations, args.threshold, not args.full,
+				args.effect_nodes, args.effect_size, args.seed, args.workers, nbsOptions, args.exact, maxSwapFraction) for idx in range(args.repeat)]
+
+			run = repeats[0]
+			run['timings'] = dict((stage, min([repeat['timings'][stage] for repeat in repeats])) for stage in run['timings'])
+			run['permutationsPerSecond'] = max([repeat['permutationsPerSecond'] for repeat in repeats])
+
+			runs.append(run)
+
+	report = js.dumps({'environment' : getEnvironment(), 'runs' : runs}, indent=2, sort_keys=True)
+
+	if args.output is None:
+		sys.stdout.write(report + '\n')
+	else:
+		with open(args.output, 'w') as reportFile:
+			reportFile.write(report + '\n')
+
+if __name__ == '__main__':
+	main()
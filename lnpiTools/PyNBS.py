@@ -0,0 +1,224 @@
+#    This program is part of the University of Minnesota Labratory for
+#    NeuroPsychiatric Imaging ToolKit
+#
+#    LNPITK is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Copyright 2011 Brent Nelson
+
+import argparse as ap
+import os as os
+
+#Runs the NBS two group comparison from the command line.  Each data directory holds one data series,
+#a <subjectId>.npy or <subjectId>.txt connectivity mtx per subject, and the groups file gives the group
+#of every subject, one "subjectId group" pair per line (# starts a comment).  numpy and nbs are only
+#imported once the arguments are parsed so --help comes straight back.
+#
+#	python PyNBS.py groups.txt fa=data/fa md=data/md --threshold 3.0 --iterations 5000 --output nbs.npz
+
+MATRIX_EXTENSIONS = ['.npy', '.txt']
+
+class MatrixFiles():
+	'''A subject's data by label, read from its file each time it's asked for so only the mtx being
+	cached is held in memory.'''
+
+	def __init__(self, fileNames):
+		self.fileNames = fileNames
+
+	def __getitem__(self, label):
+
+		import numpy as np
+
+		fileName = self.fileNames[label]
+
+		if fileName.endswith('.npy'):
+			return np.load(fileName)
+		else:
+			return np.loadtxt(fileName)
+
+class Subject():
+
+	def __init__(self, subjectId, fileNames):
+		self.subjectId = subjectId
+		self.data = MatrixFiles(fileNames)
+
+def readGroups(fileName):
+	'''Returns the (subjectId, group) pairs of a groups file in the order they're listed.'''
+
+	pairs = []
+
+	with open(fileName) as groupsFile:
+		for lineNumber, line in enumerate(groupsFile):
+
+			line = line.split('#')[0].replace(',', ' ').split()
+			if len(line) == 0:
+				continue
+
+			if len(line) != 2:
+				raise ValueError('%s line %d should be a subject id and a group' % (fileName, lineNumber + 1))
+
+			pairs.append((line[0], line[1]))
+
+	return pairs
+
+def getSeriesDirectories(dataDirectories):
+	'''Returns (label, directory) of every data directory, given as label=directory or just the directory
+	in which case its name is the label.'''
+
+	series = []
+
+	for dataDirectory in dataDirectories:
+
+		if '=' in dataDirectory:
+			label, directory = dataDirectory.split('=', 1)
+		else:
+			directory = dataDirectory
+			label = os.path.basename(os.path.normpath(directory))
+
+		if not os.path.isdir(directory):
+			raise ValueError('%s is not a directory' % directory)
+
+		if label in [seriesLabel for seriesLabel, seriesDirectory in series]:
+			raise ValueError('More than one data directory is labelled %s' % label)
+
+		series.append((label, directory))
+
+	return series
+
+def findMatrixFile(directory, subjectId):
+
+	for extension in MATRIX_EXTENSIONS:
+		fileName = os.path.join(directory, subjectId + extension)
+		if os.path.isfile(fileName):
+			return fileName
+
+	raise ValueError('No mtx for subject %s in %s' % (subjectId, directory))
+
+def getGroups(pairs, series, group1Name=None):
+	'''Splits the subjects into the two groups, group 1 being group1Name or else the first one listed.'''
+
+	groupNames = []
+	for subjectId, group in pairs:
+		if not group in groupNames:
+			groupNames.append(group)
+
+	if len(groupNames) != 2:
+		raise ValueError('The groups file should have 2 groups, not %d: %s' % (len(groupNames), ', '.join(groupNames)))
+
+	if group1Name is None:
+		group1Name = groupNames[0]
+	elif not group1Name in groupNames:
+		raise ValueError('There is no group %s in the groups file' % group1Name)
+
+	subjectIds = [subjectId for subjectId, group in pairs]
+	if len(set(subjectIds)) != len(subjectIds):
+		raise ValueError('Subjects are listed more than once in the groups file')
+
+	group1 = []
+	group2 = []
+
+	for subjectId, group in pairs:
+
+		subject = Subject(subjectId, dict((label, findMatrixFile(directory, subjectId)) for label, directory in series))
+
+		if group == group1Name:
+			group1.append(subject)
+		else:
+			group2.append(subject)
+
+	return group1, group2
+
+def getGraphName(key):
+	'''Names a graph by its label, or its label and threshold for the other thresholds of a sweep.'''
+
+	if isinstance(key, tuple):
+		return '%s at threshold %g' % key
+	else:
+		return str(key)
+
+def printResult(comparison, alpha):
+
+	print 'Permutations: %d' % comparison.permutationsUsed
+
+	# Each label's primary threshold comes first, followed by the rest of its sweep in threshold order
+	graphs = comparison.actualResult.getSeriesGraphs()
+	keys = sorted(graphs, key=lambda key: key if isinstance(key, tuple) else (key, None))
+
+	for key in keys:
+
+		graph = graphs[key]
+		components = sorted(graph.components, key=lambda component: component.pVal)
+
+		print '%s: %d components, %d significant at %g' % (getGraphName(key), len(components), len([component for component in components if component.pVal < alpha]), alpha)
+
+		for component in components:
+			if component.pVal < alpha:
+				pVals = ', '.join(['%s p = %g' % (statistic, pVal) for statistic, pVal in sorted(component.pVals.iteritems())])
+				print '\t%d nodes, %d edges, %s' % (component.len(), component.size(), pVals)
+				print '\tnodes: %s' % ' '.join([str(node) for node in sorted(component.nodes())])
+
+def main(argv=None):
+
+	parser = ap.ArgumentParser(description='Compares the connectivity of two groups of subjects with the network based statistic.')
+	parser.add_argument('groups', help='file of "subjectId group" lines, with exactly 2 groups')
+	parser.add_argument('data', nargs='+', help='directory of <subjectId>.npy or .txt mtxs for each data series, as label=directory or just the directory to label it by its name')
+	parser.add_argument('--group1', default=None, help='group tested as group 1, the first listed by default')
+	parser.add_argument('--threshold', type=float, nargs='+', required=True, help='tstat threshold, more than one runs a sweep whose first is the primary threshold')
+	parser.add_argument('--iterations', type=int, default=5000)
+	parser.add_argument('--workers', type=int, default=1)
+	parser.add_argument('--seed', type=int, default=None)
+	parser.add_argument('--exact', action='store_true', default=None, help='enumerate every group assignment instead of drawing them, done anyway when there are no more than --iterations of them')
+	parser.add_argument('--full', action='store_true', help='test full mtxs instead of the upper triangle')
+	parser.add_argument('--statistics', nargs='+', default=['extent'], choices=['extent', 'nodes', 'intensity', 'maxT'], help='component statistics given p values')
+	parser.add_argument('--cache-dir', default=None, help='cache the data in memory mapped files here')
+	parser.add_argument('--float32', action='store_true', help='cache the data as float32')
+	parser.add_argument('--fuse', action='store_true', help='fuse every series into one cache')
+	parser.add_argument('--checkpoint', default=None, help='checkpoint directory the permutations are saved to and resumed from')
+	parser.add_argument('--progress', default=None, help='JSON lines progress file, - for standard out')
+	parser.add_argument('--alpha', type=float, default=0.05, help='significance reported on')
+	parser.add_argument('--output', default=None, help='.npz file to save the result to')
+	args = parser.parse_args(argv)
+
+	try:
+		series = getSeriesDirectories(args.data)
+		group1, group2 = getGroups(readGroups(args.groups), series, args.group1)
+	except (IOError, ValueError), error:
+		parser.error(str(error))
+
+	import numpy as np
+	import lnpiLib.stat.nbs as nbs
+
+	# The node count comes from the first subject's mtxs, which every other subject has to match
+	threshold = args.threshold[0] if len(args.threshold) == 1 else args.threshold
+	dataParameters = []
+	for label, directory in series:
+		totalNodes = np.shape(group1[0].data[label])[0]
+		dataParameters.append(nbs.DataParameters(label, threshold, totalNodes, not args.full))
+
+	tStat = nbs.tStatNBS(args.cache_dir, np.float32 if args.float32 else np.float64, fuseSeries=args.fuse)
+	tStat.componentStatistics = args.statistics
+
+	if args.progress is not None:
+		tStat.observer = nbs.JSONLinesReporter(None if args.progress == '-' else args.progress)
+
+	checkpoint = None
+	if args.checkpoint is not None:
+		checkpoint = nbs.PermutationCheckpoint(args.checkpoint)
+
+	comparison = tStat.compare(group1, group2, dataParameters, args.iterations, args.workers, args.seed, checkpoint, exact=args.exact)
+
+	printResult(comparison, args.alpha)
+
+	if args.output is not None:
+		comparison.save(args.output)
+
+if __name__ == '__main__':
+	main()